@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmarks sin tocar Google Maps.
+
+  python benchmark.py micro              # importación, extracción, agrupado e informes
+  python benchmark.py replay             # scraping completo contra un servidor local
+  python benchmark.py all --save-baseline
+
+El servidor de replay sirve páginas de agencia con la misma estructura que
+usa el scraper (h1, pestaña "Reseñas", panel con scroll y tarjetas
+data-review-id) y carga las reseñas por lotes desde un endpoint con el
+formato de listentitiesreviews, así que funcionan los modos dom y network.
+Las reseñas salen de reseñas.db (crawls reales anteriores) o se generan a
+partir de los testimonios de agentes_inmobiliarios.json.
+"""
+
+import argparse, asyncio, json, os, random, resource, sqlite3, subprocess, sys, tempfile, threading, time
+from collections import Counter
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from bs4 import BeautifulSoup
+
+import bot_agentes_casa as bot
+import html_parse
+
+BASELINE_JSON = "benchmark_baseline.json"
+SAMPLE_JSON = "agentes_inmobiliarios.json"
+REVIEWS_PER_BATCH = 10  # Lo que devuelve Maps en cada carga
+AUTHORS = ["Lucía Martín", "Javier Gómez", "Ana Ruiz", "Pedro Sanz", "Marta Díaz", "Luis Moreno"]
+DATES = ["hace 3 días", "hace 2 semanas", "hace 1 mes", "hace 4 meses", "hace 8 meses"]
+
+AGENCY_PAGE = """<!doctype html><html><head><meta charset="utf-8"><title>{name}</title>
+<style>#panel{{height:600px;overflow-y:auto}} div[data-review-id]{{min-height:120px}}</style>
+</head><body><div role="main">
+<h1>{name}</h1>
+<div role="tablist"><button role="tab" id="tab">Reseñas</button></div>
+<button id="sort" aria-label="Ordenar reseñas">Ordenar</button>
+<div id="menu" role="menu" hidden><div role="menuitemradio" id="newest">Más recientes</div></div>
+<div id="panel" aria-label="Todas las reseñas de {name}" hidden></div>
+</div>
+<script>
+const AGENCY = {slug};
+const panel = document.getElementById("panel");
+let page = 0, loading = false, more = true;
+
+async function load() {{
+    if (loading || !more) return;
+    loading = true;
+    const r = await fetch(`/maps/preview/review/listentitiesreviews?agency=${{AGENCY}}&page=${{page}}`);
+    const data = JSON.parse((await r.text()).slice(4));
+    const batch = data[2] || [];
+    for (const rev of batch) {{
+        const card = document.createElement("div");
+        card.setAttribute("data-review-id", rev[10]);
+        for (const part of [rev[0][1], rev[1], rev[3]]) {{
+            const el = document.createElement("span");
+            el.textContent = part;
+            card.appendChild(el);
+        }}
+        panel.appendChild(card);
+    }}
+    more = batch.length > 0;
+    page++;
+    loading = false;
+}}
+
+document.getElementById("tab").onclick = () => {{ panel.hidden = false; load(); }};
+document.getElementById("sort").onclick = () => {{ document.getElementById("menu").hidden = false; }};
+document.getElementById("newest").onclick = () => {{ document.getElementById("menu").hidden = true; }};
+panel.addEventListener("scroll", () => {{
+    if (panel.scrollTop + panel.clientHeight >= panel.scrollHeight - 50) load();
+}});
+</script></body></html>"""
+
+
+# -------- Corpus --------
+def sample_testimonials(path=SAMPLE_JSON):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return [t["testimonio"] for a in data for agent in a["agentes_inmobiliarios"]
+            for t in agent["testimonios_clientes"]]
+
+def scaled_corpus(size, seed=0):
+    """`size` reseñas a partir de los testimonios de ejemplo.
+
+    Se cambian los nombres de agente para que el agrupado tenga variantes
+    y colisiones parecidas a las de un crawl real.
+    """
+    rnd = random.Random(seed)
+    base = sample_testimonials()
+    names = sorted(bot.NOMBRES_COMUNES_ESPANOL)
+    corpus = []
+    for i in range(size):
+        text = base[i % len(base)]
+        if i >= len(base):
+            name = rnd.choice(names).capitalize()
+            text = f"{text} Gracias a {name} por todo."
+        corpus.append(text)
+    return corpus
+
+def synthetic_fixtures(agencies, reviews_per_agency, seed=0):
+    """{slug: (nombre, [reseñas])} con reseñas generadas del corpus de ejemplo."""
+    rnd = random.Random(seed)
+    corpus = scaled_corpus(agencies * reviews_per_agency, seed)
+    fixtures = {}
+    for n in range(agencies):
+        reviews = []
+        for i, body in enumerate(corpus[n * reviews_per_agency:(n + 1) * reviews_per_agency]):
+            reviews.append({
+                "id": f"rev-{n}-{i}",
+                "author": rnd.choice(AUTHORS),
+                # Orden "más recientes": las fechas solo crecen
+                "date": DATES[min(len(DATES) - 1, i * len(DATES) // reviews_per_agency)],
+                "body": body,
+            })
+        fixtures[f"agencia-{n}"] = (f"Inmobiliaria de prueba {n}", reviews)
+    return fixtures
+
+def store_fixtures(path):
+    """Las reseñas guardadas en reseñas.db por crawls reales anteriores."""
+    db = sqlite3.connect(path)
+    fixtures = {}
+    for n, (url, name) in enumerate(db.execute("SELECT agency_url, agency_name FROM agencies")):
+        rows = db.execute("SELECT review_key, text FROM reviews WHERE agency_url = ? ORDER BY rowid", (url,))
+        reviews = [{"id": key, "author": "", "date": "hace 1 mes", "body": text} for key, text in rows]
+        fixtures[f"agencia-{n}"] = (name, reviews)
+    db.close()
+    return fixtures
+
+
+def maps_like_html(cards, review_ids=True, seed=0):
+    """Página con la anidación típica de Maps (muchos divs envolviendo cada tarjeta).
+
+    Sin `review_ids` las tarjetas no tienen data-review-id ni jsaction, así
+    que el parseo cae en el modo sin selectores.
+    """
+    rnd = random.Random(seed)
+    corpus = scaled_corpus(cards, seed)
+    parts = ["<html><body><div role='main'><div><div><h1>Inmobiliaria de prueba</h1></div>"]
+    for i, body in enumerate(corpus):
+        attr = f" data-review-id='r{i}'" if review_ids else ""
+        parts.append(
+            f"<div{attr}><div><div><div><button>{rnd.choice(AUTHORS)}</button><div>Local Guide</div></div>"
+            f"<div><span>★★★★★</span><span>{rnd.choice(DATES)}</span></div>"
+            f"<div><div><span>{escape(body)}</span></div></div>"
+            f"<div><button>Me gusta</button><button>Compartir</button></div></div></div></div>"
+        )
+    parts.append("</div></div></body></html>")
+    return "".join(parts)
+
+def legacy_review_cards(html):
+    """El parseo de antes (BeautifulSoup + todos los divs), para comparar."""
+    soup = BeautifulSoup(html, "html.parser")
+    cards = soup.select("div[data-review-id]")
+    if not cards:
+        cards = soup.select("div[jsaction*='review']")
+    if not cards:
+        cards = [d for d in soup.find_all("div") if 50 < len(d.get_text(strip=True)) < 5000]
+    return [card.get_text(" ", strip=True) for card in cards]
+
+
+# -------- Servidor de replay --------
+class ReplayServer:
+    """Sirve las agencias de `fixtures` en localhost desde un hilo."""
+
+    def __init__(self, fixtures, latency_ms=0):
+        self.fixtures = fixtures
+        self.latency = latency_ms / 1000
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                status, ctype, body = server.route(self.path)
+                payload = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def urls(self):
+        return [f"{self.base_url}/agency/{slug}" for slug in self.fixtures]
+
+    def route(self, path):
+        url = urlparse(path)
+        if url.path.startswith("/agency/"):
+            slug = url.path[len("/agency/"):]
+            if slug in self.fixtures:
+                name = escape(self.fixtures[slug][0])
+                return 200, "text/html; charset=utf-8", AGENCY_PAGE.format(name=name, slug=json.dumps(slug))
+        elif bot.is_review_rpc(url.path):
+            query = parse_qs(url.query)
+            slug = query.get("agency", [""])[0]
+            if slug in self.fixtures:
+                time.sleep(self.latency)
+                page = int(query.get("page", ["0"])[0])
+                batch = self.fixtures[slug][1][page * REVIEWS_PER_BATCH:(page + 1) * REVIEWS_PER_BATCH]
+                # Posiciones que lee review_rpc.decode_review_payload
+                rows = [[[None, r["author"]], r["date"], None, r["body"], None, None, None, None, None, None, r["id"]]
+                        for r in batch]
+                return 200, "application/json; charset=utf-8", ")]}'\n" + json.dumps([None, None, rows])
+        return 404, "text/plain", "not found"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# -------- Medición --------
+# Lo que bot_agentes_casa solo debería importar al usarlo
+HEAVY_MODULES = ("playwright", "spacy", "rapidfuzz", "numpy", "openpyxl", "pyarrow", "bs4", "lxml")
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(name, fn, units, unit, repeat=1):
+    """Mejor tiempo de `repeat` ejecuciones de fn(); devuelve la fila de resultados."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return {"name": name, "seconds": round(best, 4), "rate": round(units / best, 2) if best else 0.0,
+            "unit": unit, "peak_rss_mb": round(peak_rss_mb(), 1)}
+
+def measure_import(module="bot_agentes_casa", repeat=1):
+    """Importa `module` en un proceso nuevo (mejor de `repeat`): tiempo, RSS y dependencias pesadas cargadas."""
+    code = ("import json, resource, sys, time\n"
+            "t0 = time.perf_counter()\n"
+            f"import {module}\n"
+            "print(json.dumps([time.perf_counter() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,"
+            f" [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))")
+    runs = [json.loads(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                      cwd=os.path.dirname(os.path.abspath(__file__))).stdout)
+            for _ in range(repeat)]
+    seconds, rss, loaded = min(runs)
+    print(f"   import {module}: {', '.join(loaded) or 'sin dependencias pesadas'}")
+    return {"name": f"import {module}", "seconds": round(seconds, 4), "rate": round(1 / seconds, 2),
+            "unit": "imports/s", "peak_rss_mb": round(rss, 1)}
+
+def run_micro(scale, repeat, html_files=()):
+    corpus = scaled_corpus(scale)
+    results = [measure_import(repeat=repeat)]
+
+    # Parseo de HTML: páginas de Maps guardadas o, si no hay, una imitación
+    pages = []
+    for path in html_files:
+        with open(path, encoding="utf-8") as f:
+            pages.append(f.read())
+    if not pages:
+        pages = [maps_like_html(min(scale, 200)), maps_like_html(min(scale, 200), review_ids=False)]
+    results.append(measure("review_cards[bs4, antes]", lambda: [legacy_review_cards(p) for p in pages],
+                           len(pages), "páginas/s", repeat))
+    results.append(measure(f"review_cards[{html_parse.BACKEND}]",
+                           lambda: [html_parse.review_cards(p) for p in pages],
+                           len(pages), "páginas/s", repeat))
+    results.append(measure(f"agency_name[{html_parse.BACKEND}]",
+                           lambda: [html_parse.agency_name(p) for p in pages],
+                           len(pages), "páginas/s", repeat))
+
+    results.append(measure("extract_names_from_text",
+                           lambda: [bot.extract_names_from_text(t) for t in corpus],
+                           len(corpus), "reseñas/s", repeat))
+    results.append(measure("process_reviews_for_agents",
+                           lambda: bot.process_reviews_for_agents(corpus),
+                           len(corpus), "reseñas/s", repeat))
+
+    _, mentions = bot.process_reviews_for_agents(corpus)
+    rnd = random.Random(0)
+    names = sorted(bot.NOMBRES_COMUNES_ESPANOL)
+    counts = Counter({n: len(m) for n, m in mentions.items()})
+    # Variantes con apellidos para que haya bastante que agrupar
+    for _ in range(scale):
+        counts[f"{rnd.choice(names).capitalize()} {rnd.choice(names).capitalize()}"] += 1
+    results.append(measure("group_similar", lambda: bot.group_similar(counts),
+                           len(counts), "nombres/s", repeat))
+
+    with open(SAMPLE_JSON, encoding="utf-8") as f:
+        sample = json.load(f)
+    agencies = [sample[i % len(sample)] for i in range(max(len(sample), scale // 10))]
+    results.append(measure("generate_html", lambda: bot.generate_html(agencies),
+                           len(agencies), "agencias/s", repeat))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xlsx = os.path.join(tmp, "bench.xlsx")
+        results.append(measure("generate_excel", lambda: bot.generate_excel(agencies, xlsx),
+                               len(agencies), "agencias/s", repeat))
+    return results
+
+def run_replay(fixtures, engine, latency_ms, workers):
+    bot.MAX_WORKERS = workers
+    # Sin pausas de cortesía: contra localhost solo medirían el sleep
+    bot.PACER.delay = bot.PACER.floor = bot.PACER.ceiling = 0
+    # Ni límite de ritmo ni esperas entre reintentos: medirían el token bucket, no el crawl
+    bot.AGENCIES_PER_MINUTE = None
+    bot.RETRY_BASE_DELAY = 0
+
+    results = []
+    with ReplayServer(fixtures, latency_ms) as server:
+        urls = server.urls()
+        t0 = time.perf_counter()
+        if engine == "async":
+            asyncio.run(bot.crawl_async(urls, results.append))
+        else:
+            bot.crawl_threads(urls, results.append)
+        elapsed = time.perf_counter() - t0
+
+    reviews = sum(len(r["reviews"]) for r in results)
+    print(f"   {len(results)}/{len(urls)} agencias, {reviews} reseñas, {server.requests} peticiones")
+    return [
+        {"name": f"replay_{engine}", "seconds": round(elapsed, 3),
+         "rate": round(len(results) * 60 / elapsed, 2), "unit": "agencias/min",
+         "peak_rss_mb": round(peak_rss_mb(), 1)},
+        {"name": f"replay_{engine}_reviews", "seconds": round(elapsed, 3),
+         "rate": round(reviews / elapsed, 2), "unit": "reseñas/s",
+         "peak_rss_mb": round(peak_rss_mb(), 1)},
+    ]
+
+def report(results, baseline):
+    print(f"\n{'benchmark':32} {'tiempo':>9} {'ritmo':>14} {'':12} {'RSS pico':>9} {'vs base':>8}")
+    for r in results:
+        base = baseline.get(r["name"])
+        delta = f"{100 * (r['rate'] / base['rate'] - 1):+7.1f}%" if base and base["rate"] else ""
+        print(f"{r['name']:32} {r['seconds']:8.3f}s {r['rate']:14.1f} {r['unit']:12} "
+              f"{r['peak_rss_mb']:8.1f}M {delta:>8}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks offline del scraper y de la extracción.")
+    parser.add_argument("suite", choices=["micro", "replay", "all"])
+    parser.add_argument("--scale", type=int, default=2000,
+                        help="Reseñas del corpus de los micro-benchmarks (por defecto: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Repeticiones por micro-benchmark; se queda el mejor tiempo (por defecto: %(default)s)")
+    parser.add_argument("--html", nargs="*", default=[], metavar="FICHERO",
+                        help="Páginas de Maps guardadas para medir el parseo (por defecto, una imitación)")
+    parser.add_argument("--agencies", type=int, default=6,
+                        help="Agencias servidas en el replay (por defecto: %(default)s)")
+    parser.add_argument("--reviews", type=int, default=60,
+                        help="Reseñas por agencia en el replay (por defecto: %(default)s)")
+    parser.add_argument("--from-store", metavar="DB",
+                        help="Servir las reseñas guardadas en esta base (p. ej. reseñas.db) en vez de sintéticas")
+    parser.add_argument("--engine", choices=["threads", "async"], default=bot.ENGINE)
+    parser.add_argument("--workers", type=int, default=bot.MAX_WORKERS)
+    parser.add_argument("--reviews-from", choices=["dom", "network"], default=bot.REVIEW_SOURCE)
+    parser.add_argument("--latency-ms", type=int, default=150,
+                        help="Retardo de cada lote de reseñas del servidor (por defecto: %(default)s)")
+    parser.add_argument("--baseline", default=BASELINE_JSON)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Guardar estos resultados como referencia")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    bot.REVIEW_SOURCE = args.reviews_from
+    # Medir la extracción de verdad, no la caché
+    bot.EXTRACTION_CACHE_DB = None
+
+    results = []
+    if args.suite in ("micro", "all"):
+        print(f"🔬 Micro-benchmarks ({args.scale} reseñas, mejor de {args.repeat})")
+        results += run_micro(args.scale, args.repeat, args.html)
+    if args.suite in ("replay", "all"):
+        fixtures = (store_fixtures(args.from_store) if args.from_store
+                    else synthetic_fixtures(args.agencies, args.reviews))
+        print(f"🌐 Replay local ({len(fixtures)} agencias, motor {args.engine})")
+        results += run_replay(fixtures, args.engine, args.latency_ms, args.workers)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {r["name"]: r for r in json.load(f)}
+    report(results, baseline)
+
+    if args.save_baseline:
+        merged = dict(baseline, **{r["name"]: r for r in results})
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(list(merged.values()), f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Referencia guardada en {args.baseline}")
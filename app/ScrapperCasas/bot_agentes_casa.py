@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import json, re, time, random
-from collections import Counter, defaultdict
+import argparse, asyncio, csv, hashlib, heapq, importlib.metadata, itertools, json, multiprocessing, os, queue, re, socket, threading, time, random
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from bs4 import BeautifulSoup
 from tqdm import tqdm
-from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
-import pandas as pd
-import spacy
-from rapidfuzz import process, fuzz
+
+# Playwright, spaCy, rapidfuzz/numpy, openpyxl, pyarrow y bs4/lxml se importan
+# en el primer uso: --help, --reprocess o importar una función no los cargan
+from review_rpc import ReviewCapture, is_review_rpc
+from review_store import ReviewStore, review_key
+from review_identity import ReviewDeduper, fingerprint, known_index
+from extraction_cache import ExtractionCache, text_hash
+from checkpoint import JsonlCheckpoint, JsonlShards
+from work_queue import LeaseQueue
+from pacing import (AdaptiveConcurrency, AsyncAdaptiveConcurrency, PacingController, TokenBucket, backoff_delay,
+                    pause, pause_async, record_throttle, record_timeout, start_agency_stats, waiting)
+from metrics import METRICS, incr, response_size, serve_prometheus, set_agency, set_gauge, stage
 
 # ---------------- CONFIG ----------------
 # 🔥 21 AGENCIAS DE MÓSTOLES
@@ -36,24 +44,80 @@ AGENCY_URLS = [
     "https://www.google.com/maps/place/Tecnorete+agencia+inmobiliaria/data=!4m7!3m6!1s0xd418dafb833c525:0x86e05b7b2a002863!8m2!3d40.3235692!4d-3.8672236!16s%2Fg%2F11x964zgwq!19sChIJJcUzuK-NQQ0RYygAKntb4IY",
 ]
 
+AGENCIES_FILE = None  # CSV/JSONL/texto con las URLs; si se da, sustituye a AGENCY_URLS
+LEASE_TTL = 600  # Segundos de alquiler de una agencia de la cola (se renueva mientras se scrapea)
+LEASE_BATCH = 10  # Agencias que alquila un worker de una vez
+
 MAX_REVIEWS_PER_AGENCY = 200
 MAX_MONTHS_OLD = 12
-MAX_WORKERS = 3  # Procesamiento paralelo (1-5 según tu CPU)
+MAX_WORKERS = 3  # Máximo de navegadores; la concurrencia real se adapta a los bloqueos de Maps
+MIN_WORKERS = 1  # Hasta dónde puede bajar la concurrencia adaptativa
+AGENCIES_PER_MINUTE = 20  # Agencias empezadas por minuto como mucho (None = sin límite)
+MAX_RETRIES = 2  # Reintentos de una agencia fallida o frenada por Maps
+RETRY_BASE_DELAY = 30  # Segundos antes del primer reintento (se dobla en cada uno, con jitter)
+BROWSER_RECYCLE_AFTER = 25  # Páginas por navegador antes de relanzarlo
+ENGINE = "threads"  # "threads" (Playwright síncrono) o "async" (asyncio)
+PAGES_PER_BROWSER = 4  # Pestañas simultáneas por navegador (solo motor async)
+REVIEW_SOURCE = "dom"  # "dom" (scroll + HTML) o "network" (respuestas XHR de Maps)
+NETWORK_WAIT_MS = 5000  # Espera máxima por cada página de reseñas en modo network
+# Techos de las esperas por condición (ms)
+PAGE_WAIT_MS = 10000  # Hasta que aparece el nombre de la agencia
+CONSENT_WAIT_MS = 5000  # Hasta que aparece el botón en la página de consentimiento
+CONSENT_STATE_JSON = "consentimiento_google.json"  # Cookies de consentimiento reutilizadas entre contextos (None = no guardar)
+BLOCK_RESOURCES = True  # Abortar imágenes, vídeo, fuentes, teselas del mapa y rastreadores
+TAB_BUTTON_WAIT_MS = 3000  # Hasta que aparece la pestaña "Reseñas"
+TAB_WAIT_MS = 8000  # Hasta que aparece la primera reseña tras abrir la pestaña
+CONTAINER_WAIT_MS = 2000  # Hasta que aparece el panel con la lista de reseñas
+SCROLL_WAIT_MS = 4000  # Hasta que el scroll carga más tarjetas
+MAX_SCROLL_TIMEOUTS = 3  # Scrolls seguidos sin tarjetas nuevas antes de dar la lista por acabada
 
 OUTPUT_JSON = "agentes_inmobiliarios.json"
 OUTPUT_HTML = "agentes_inmobiliarios.html"
 OUTPUT_EXCEL = "agentes_inmobiliarios.xlsx"
+OUTPUT_PARQUET = "agentes_inmobiliarios_{table}.parquet"  # Una tabla por fichero: agencias, agentes, testimonios
+PARQUET_EXPORT = False  # Exportar también a Parquet (requiere pyarrow)
+PARQUET_BATCH = 10_000  # Filas por grupo al escribir Parquet
+CHECKPOINT_JSONL = "scraping_checkpoint.jsonl"  # Resultados de scraping según terminan (para --resume)
+AGENCIES_JSONL = "agentes_inmobiliarios.jsonl"  # Agencias procesadas, una por línea
+REVIEW_DB = "reseñas.db"  # Almacén de reseñas en bruto entre ejecuciones
+QUERY_DB = "consultas.db"  # Índice para query_service.py (agentes, testimonios, ranking); None = no crearlo
+INCREMENTAL = False  # Parar al llegar a reseñas ya guardadas y procesar solo las nuevas
+TRACE_JSON = None  # p. ej. "traza.json": tiempos por etapa y agencia (formato Chrome/Perfetto)
+PROMETHEUS_PORT = None  # Puerto para exponer /metrics durante la ejecución
+NLP_WORKERS = 1  # Procesos de extracción en paralelo al scraping (0 = en el proceso principal)
+PIPELINE_QUEUE = 8  # Agencias scrapeadas en cola antes de frenar el scraping
 
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120 Safari/537.36",
 ]
 HEADLESS = True  # Cambia a False para ver el navegador
+
+SPACY_MODEL = "es_core_news_sm"
+# Solo usamos doc.ents (PER): el resto del pipeline no hace falta
+SPACY_EXCLUDE = ["parser", "lemmatizer", "morphologizer", "attribute_ruler", "senter"]
+NER_BATCH_SIZE = 64
+NER_PROCESSES = 1  # >1 reparte spaCy en varios procesos
+CLUSTER_CUTOFF = 85  # Similitud mínima (token_sort_ratio) para agrupar variantes de un nombre
+CLUSTER_BLOCK = 2048  # Filas de la matriz de similitud por bloque (acota la memoria)
+CLUSTER_WORKERS = -1  # Hilos para rapidfuzz.cdist (-1 = todos los núcleos)
+LINK_ACROSS_AGENCIES = False  # Enlazar el mismo agente en varias oficinas
+EXTRACTION_CACHE_DB = "extraccion_cache.db"  # None desactiva la caché de extracción
+EXTRACTION_CACHE_MAX = 200_000  # Entradas antes de expulsar las menos usadas
+EXTRACTION_RULES_REV = 1  # Súbelo al cambiar la lógica de extracción (invalida la caché)
 # ----------------------------------------
 
-nlp = spacy.load("es_core_news_sm")
+nlp = None  # Modelo de spaCy, cargado en el primer uso (get_nlp)
+
+def get_nlp():
+    global nlp
+    if nlp is None:
+        import spacy
+        with stage("load_spacy"):
+            nlp = spacy.load(SPACY_MODEL, exclude=SPACY_EXCLUDE)
+    return nlp
 
-def rnd_sleep(a=0.8, b=1.5): 
-    time.sleep(random.uniform(a, b))
+# Pausa de cortesía compartida por todo el crawl (se adapta a la latencia de Maps)
+PACER = PacingController(base=1.0, floor=0.2, ceiling=5.0)
 
 # -------- Diccionario de nombres españoles --------
 NOMBRES_COMUNES_ESPANOL = {
@@ -73,22 +137,23 @@ NOMBRES_COMUNES_ESPANOL = {
     "sofía", "sofia", "valentina", "emma", "martina", "valeria", "carla", "jimena"
 }
 
+# Excluir palabras claramente no nombres
+EXCLUDED_NAME_WORDS = frozenset({
+    "nos", "muy", "todo", "ello", "por", "dos", "tres", "disposición", "inmobiliaria", 
+    "redpiso", "empresa", "equipo", "agencia", "gracias", "atención", "servicio",
+    "oficina", "personal", "gente", "ellos", "ellas", "vosotros", "pueden"
+})
+
+@lru_cache(maxsize=65536)
 def is_valid_spanish_name(name):
-    """Verifica si es un nombre válido español."""
+    """Verifica si es un nombre válido español (memoizado: se repite mucho)."""
     if not name or len(name) < 2:
         return False
     
     name_lower = name.lower().strip()
     words = name_lower.split()
     
-    # Excluir palabras claramente no nombres
-    excluded = {
-        "nos", "muy", "todo", "ello", "por", "dos", "tres", "disposición", "inmobiliaria", 
-        "redpiso", "empresa", "equipo", "agencia", "gracias", "atención", "servicio",
-        "oficina", "personal", "gente", "ellos", "ellas", "vosotros", "pueden"
-    }
-    
-    if name_lower in excluded or any(word in excluded for word in words):
+    if name_lower in EXCLUDED_NAME_WORDS or any(word in EXCLUDED_NAME_WORDS for word in words):
         return False
     
     # Si tiene 1 palabra, debe estar en el diccionario
@@ -108,42 +173,99 @@ def is_valid_spanish_name(name):
     return False
 
 # -------- Extracción de nombres MEJORADA --------
-def extract_names_from_text(text):
-    """Extrae nombres de agentes inmobiliarios."""
+NAME_RE = r"[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2}"
+
+# Patrones de contexto, en el orden en que se aplican. Cada uno lleva las
+# palabras clave sin las que no puede coincidir, para saltarlo si no aparecen.
+NAME_PATTERNS = [
+    (("gracias a",), rf"gracias a ({NAME_RE})"),
+    (("gracias a",), rf"muchas gracias a ({NAME_RE})"),
+    (("atendió", "ayudó", "asesoró", "gestionó"), rf"(?:nos|me)\s+(?:atendió|ayudó|asesoró|gestionó)\s+({NAME_RE})"),
+    (("atendió",), rf"atendió\s+({NAME_RE})"),
+    (("agente",), rf"(?:el|la)\s+agente\s+({NAME_RE})"),
+    (("con",), rf"(?:con|contacté con|hablé con|trabajé con)\s+({NAME_RE})"),
+    (("recomiendo a",), rf"recomiendo a ({NAME_RE})"),
+    (("que",), rf"({NAME_RE}),?\s+que\s+(?:fue|es|era)"),
+    (("ha",), rf"({NAME_RE})\s+ha\s+sido"),
+    (("en especial",), rf"en especial (?:a\s+)?({NAME_RE})"),
+    (("especialmente",), rf"especialmente (?:a\s+)?({NAME_RE})"),
+]
+COMPILED_NAME_PATTERNS = [re.compile(p, re.IGNORECASE) for _, p in NAME_PATTERNS]
+
+# Todas las palabras clave en un solo regex. Cada una es un grupo propio dentro
+# de un lookahead, así se encuentran también las que se solapan.
+NAME_TRIGGERS = sorted({kw for kws, _ in NAME_PATTERNS for kw in kws})
+TRIGGER_RE = re.compile(
+    "(?=" + "|".join(f"({re.escape(kw)})" for kw in NAME_TRIGGERS) + ")",
+    re.IGNORECASE,
+)
+PATTERNS_BY_TRIGGER = [
+    [i for i, (kws, _) in enumerate(NAME_PATTERNS) if kw in kws]
+    for kw in NAME_TRIGGERS
+]
+
+NER_ARTICLE_RE = re.compile(r'^(el|la|los|las|un|una|de|del)\s+', re.IGNORECASE)
+PATTERN_ARTICLE_RE = re.compile(r'^(el|la|los|las|de|del|a)\s+', re.IGNORECASE)
+EDGE_PUNCT_RE = re.compile(r"^[\W_]+|[\W_]+$")
+SPACES_RE = re.compile(r"\s+")
+
+def triggered_patterns(text):
+    """Índices (ordenados) de los patrones cuyas palabras clave están en el texto."""
+    hits = set()
+    for m in TRIGGER_RE.finditer(text):
+        hits.update(PATTERNS_BY_TRIGGER[m.lastindex - 1])
+    return sorted(hits)
+
+def person_names(doc):
+    """Nombres PER válidos de un Doc de spaCy."""
+    names = []
+    for ent in doc.ents:
+        if ent.label_ == "PER":
+            name = ent.text.strip()
+            name = NER_ARTICLE_RE.sub('', name)
+            if is_valid_spanish_name(name):
+                names.append(name)
+    return names
+
+def batch_person_names(texts, batch_size=None, n_process=None):
+    """NER por lotes con nlp.pipe: una lista de nombres PER por texto."""
+    texts = [t[:2000] for t in texts]
+    try:
+        return [person_names(doc) for doc in get_nlp().pipe(
+            texts,
+            batch_size=batch_size or NER_BATCH_SIZE,
+            n_process=n_process or NER_PROCESSES,
+        )]
+    except Exception:
+        # Un texto problemático no debe tumbar el lote entero
+        results = []
+        for text in texts:
+            try:
+                results.append(person_names(get_nlp()(text)))
+            except:
+                results.append([])
+        return results
+
+def extract_names_from_text(text, ner_names=None):
+    """Extrae nombres de agentes inmobiliarios.
+    
+    `ner_names` permite pasar el resultado de batch_person_names ya calculado.
+    """
     candidates = []
     
     # 1. spaCy NER
-    try:
-        doc = nlp(text[:2000])
-        for ent in doc.ents:
-            if ent.label_ == "PER":
-                name = ent.text.strip()
-                name = re.sub(r'^(el|la|los|las|un|una|de|del)\s+', '', name, flags=re.IGNORECASE)
-                if is_valid_spanish_name(name):
-                    candidates.append(name)
-    except:
-        pass
-    
-    # 2. Patrones específicos
-    patterns = [
-        r"gracias a ([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})",
-        r"muchas gracias a ([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})",
-        r"(?:nos|me)\s+(?:atendió|ayudó|asesoró|gestionó)\s+([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})",
-        r"atendió\s+([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})",
-        r"(?:el|la)\s+agente\s+([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})",
-        r"(?:con|contacté con|hablé con|trabajé con)\s+([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})",
-        r"recomiendo a ([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})",
-        r"([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2}),?\s+que\s+(?:fue|es|era)",
-        r"([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})\s+ha\s+sido",
-        r"en especial (?:a\s+)?([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})",
-        r"especialmente (?:a\s+)?([A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+(?:\s+[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñ]+){0,2})",
-    ]
+    if ner_names is None:
+        try:
+            ner_names = person_names(get_nlp()(text[:2000]))
+        except:
+            ner_names = []
+    candidates.extend(ner_names)
     
-    for pattern in patterns:
-        matches = re.findall(pattern, text, flags=re.IGNORECASE)
-        for match in matches:
+    # 2. Patrones específicos (solo los que pueden coincidir)
+    for i in triggered_patterns(text):
+        for match in COMPILED_NAME_PATTERNS[i].findall(text):
             name = match.strip() if isinstance(match, str) else match[0].strip()
-            name = re.sub(r'^(el|la|los|las|de|del|a)\s+', '', name, flags=re.IGNORECASE)
+            name = PATTERN_ARTICLE_RE.sub('', name)
             if is_valid_spanish_name(name):
                 candidates.append(name)
     
@@ -152,8 +274,8 @@ def extract_names_from_text(text):
     seen = set()
     
     for name in candidates:
-        name = re.sub(r"^[\W_]+|[\W_]+$", "", name).strip()
-        name = re.sub(r"\s+", " ", name)
+        name = EDGE_PUNCT_RE.sub("", name).strip()
+        name = SPACES_RE.sub(" ", name)
         name = " ".join(word.capitalize() for word in name.split())
         
         name_lower = name.lower()
@@ -164,44 +286,178 @@ def extract_names_from_text(text):
     
     return cleaned
 
+# Contextos que delatan a un agente: "<antes><nombre>" o "<nombre><después>"
+AGENT_CONTEXT_BEFORE = ("gracias a ", "atendió ", "agente ", "con ", "especial ", "recomiendo ")
+AGENT_CONTEXT_AFTER = (" atendió", " ha sido", ", que")
+
 def is_likely_agent_name(name, review_text):
-    """Validación contextual."""
-    name_lower = name.lower()
-    review_lower = review_text.lower()
+    """Validación contextual.
     
+    Recorre una vez las apariciones del nombre y mira qué hay justo antes y
+    después, en vez de buscar cada combinación contexto+nombre por separado.
+    """
     if not is_valid_spanish_name(name):
         return False
     
-    patterns = [
-        f"gracias a {name_lower}",
-        f"atendió {name_lower}",
-        f"{name_lower} atendió",
-        f"agente {name_lower}",
-        f"con {name_lower}",
-        f"especial {name_lower}",
-        f"recomiendo {name_lower}",
-        f"{name_lower} ha sido",
-        f"{name_lower}, que",
-    ]
+    name_lower = name.lower()
+    review_lower = review_text.lower()
+    
+    i = review_lower.find(name_lower)
+    while i != -1:
+        if (review_lower.endswith(AGENT_CONTEXT_BEFORE, 0, i) or
+                review_lower.startswith(AGENT_CONTEXT_AFTER, i + len(name_lower))):
+            return True
+        i = review_lower.find(name_lower, i + 1)
     
-    return any(p in review_lower for p in patterns)
+    return False
 
 # -------- Helpers --------
+CONSENT_SELECTORS = ["button:has-text('Aceptar todo')", "button:has-text('Aceptar')"]
+REVIEWS_TAB_SELECTORS = ["button[role='tab']:has-text('Reseñas')", "button:has-text('Reseñas')"]
+SORT_BUTTON_SELECTOR = "button[aria-label*='Ordenar'], button:has-text('Ordenar')"
+SORT_NEWEST_SELECTOR = "[role='menuitemradio']:has-text('Más recientes')"
+REVIEWS_CONTAINER_SELECTORS = ["div[aria-label*='reseñ']", "div[role='main']"]
+VER_MAS_SELECTOR = "button:has-text('Ver más'), button:has-text('Más')"
+REVIEW_CARD_SELECTOR = "div[data-review-id], div[jsaction*='review']"
+CARD_COUNT_JS = """
+() => document.querySelectorAll("div[data-review-id]").length ||
+      document.querySelectorAll("div[jsaction*='review']").length
+"""
+MORE_CARDS_JS = """
+(n) => (document.querySelectorAll("div[data-review-id]").length ||
+        document.querySelectorAll("div[jsaction*='review']").length) > n
+"""
+SCROLL_JS = "(el)=>{el.scrollBy(0, el.scrollHeight)}"
+WINDOW_SCROLL_JS = "window.scrollBy(0, window.innerHeight * 3)"
+MAX_SCROLLS = 50
+MAX_STALE_SCROLLS = 10
+
+# Extractor incremental: se ejecuta dentro de la página y solo devuelve las
+# tarjetas que no había devuelto antes (por data-review-id o por elemento).
+# El texto reproduce get_text(" ", strip=True) de BeautifulSoup.
+EXTRACT_NEW_CARDS_JS = """
+() => {
+    const state = window.__scraperReviews ||
+        (window.__scraperReviews = {ids: new Set(), els: new WeakSet()});
+
+    // Sin selectores: divs hoja con longitud de reseña (50-5000), en un
+    // solo recorrido que mide cada nodo de texto una vez
+    const leafCards = () => {
+        const leaves = [];
+        const walk = (el) => {
+            if (el.tagName === "SCRIPT" || el.tagName === "STYLE" || el.tagName === "TEMPLATE") return [0, false];
+            let size = 0, nested = false;
+            for (let c = el.firstChild; c; c = c.nextSibling) {
+                if (c.nodeType === Node.TEXT_NODE) {
+                    size += c.nodeValue.trim().length;
+                } else if (c.nodeType === Node.ELEMENT_NODE) {
+                    const [s, n] = walk(c);
+                    size += s;
+                    nested = nested || n;
+                }
+            }
+            const card = el.tagName === "DIV" && size > 50 && size < 5000;
+            if (card && !nested) leaves.push(el);
+            return [size, nested || card];
+        };
+        if (document.body) walk(document.body);
+        return leaves;
+    };
+
+    let cards = document.querySelectorAll("div[data-review-id]");
+    if (!cards.length) cards = document.querySelectorAll("div[jsaction*='review']");
+    if (!cards.length) cards = leafCards();
+
+    const textParts = (el) => {
+        const walker = document.createTreeWalker(el, NodeFilter.SHOW_TEXT);
+        const parts = [];
+        for (let n = walker.nextNode(); n; n = walker.nextNode()) {
+            const t = n.nodeValue.trim();
+            if (t) parts.push(t);
+        }
+        return parts;
+    };
+
+    const out = [];
+    const emitted = new Set();
+    for (const el of cards) {
+        const id = el.getAttribute("data-review-id");
+        const dirty = el.dataset.scraperDirty === "1";
+        if (dirty) delete el.dataset.scraperDirty;
+        if (id ? (emitted.has(id) || (state.ids.has(id) && !dirty)) : (state.els.has(el) && !dirty)) continue;
+
+        const parts = textParts(el);
+        if (id) { state.ids.add(id); emitted.add(id); } else { state.els.add(el); }
+        out.push({
+            id: id || "",
+            text: parts.join(" "),
+            date: parts.find((p) => /^hace\s/i.test(p)) || "",
+        });
+    }
+    return out;
+}
+"""
+# Marca la tarjeta de un botón "Ver más" para que el extractor la relea expandida
+MARK_CARD_DIRTY_JS = """
+(btn) => {
+    for (let c = btn.closest("div[data-review-id]"); c; c = c.parentElement && c.parentElement.closest("div[data-review-id]")) {
+        c.dataset.scraperDirty = "1";
+    }
+}
+"""
+
+REVIEW_GOOD_KW = ["inmobiliaria", "agente", "casa", "piso", "vivienda", "alquiler", "venta", "compra"]
+REVIEW_BAD_KW = ["coche", "auto", "vehículo", "moto", "taller", "gasolina"]
+
+def wait_for(condition, timeout):
+    """Espera a que `condition(timeout)` se cumpla, con techo de tiempo.
+    
+    Cuenta como espera en las estadísticas de la agencia y pasa la latencia
+    al PACER. Devuelve False si se agotó el tiempo.
+    """
+    from playwright.sync_api import TimeoutError as PWTimeout
+    t0 = time.perf_counter()
+    timed_out = False
+    with waiting():
+        try:
+            condition(timeout)
+        except PWTimeout:
+            timed_out = True
+            record_timeout()
+            incr("timeouts")
+    PACER.observe(time.perf_counter() - t0, timed_out)
+    return not timed_out
+
+def throttle_signal(page, response):
+    """Si Maps nos está frenando: "http_429" o "captcha" (página de tráfico inusual, /sorry/); si no, None."""
+    if response is not None and response.status == 429:
+        return "http_429"
+    if "/sorry/" in page.url:
+        return "captcha"
+    return None
+
+def consent_given(cookies):
+    from browser_pool import CONSENT_COOKIES
+    return any(c["name"] in CONSENT_COOKIES for c in cookies)
+
 def accept_consent(page):
-    for sel in ["button:has-text('Aceptar todo')", "button:has-text('Aceptar')"]:
+    # Con las cookies de consentimiento guardadas Maps ya no lo pide
+    if "consent." not in page.url and consent_given(page.context.cookies()):
+        return
+    # Solo la página de consentimiento de Google justifica esperar al botón
+    if "consent." in page.url:
+        wait_for(lambda t: page.locator(", ".join(CONSENT_SELECTORS)).first.wait_for(state="visible", timeout=t),
+                 CONSENT_WAIT_MS)
+    
+    for sel in CONSENT_SELECTORS:
         try:
-            btn = page.locator(sel)
-            if btn.first.is_visible(timeout=1000):
-                btn.first.click()
-                time.sleep(0.5)
+            btn = page.locator(sel).first
+            if btn.is_visible():
+                btn.click()
+                page.wait_for_load_state()
                 return
         except: pass
 
-def wait_network_quiet(page, t=3000):
-    try:
-        page.wait_for_load_state("networkidle", timeout=t)
-    except: pass
-
 def parse_review_age_months(text):
     patterns = [
         (r"hace\s+(\d+)\s+día(?:s)?", lambda x: int(x) / 30),
@@ -216,126 +472,344 @@ def parse_review_age_months(text):
             return converter(match.group(1))
     return 0
 
+# Nombre de la agencia sin traer el HTML de la página: como get_text(strip=True)
+AGENCY_NAME_JS = """
+() => {
+    const el = document.querySelector("h1") || document.querySelector("h2");
+    if (!el) return "SinNombre";
+    const walker = document.createTreeWalker(el, NodeFilter.SHOW_TEXT);
+    const parts = [];
+    for (let n = walker.nextNode(); n; n = walker.nextNode()) parts.push(n.nodeValue.trim());
+    return parts.join("");
+}
+"""
+
+def parse_agency_name(html):
+    import html_parse
+    return html_parse.agency_name(html)
+
+def parse_review_cards(html):
+    """Devuelve el texto de cada tarjeta de reseña del HTML."""
+    import html_parse
+    return html_parse.review_cards(html)
+
+def agency_name(tab):
+    try:
+        return tab.evaluate(AGENCY_NAME_JS)
+    except Exception:
+        return parse_agency_name(tab.content())
+
+def extract_new_cards(tab):
+    """Tarjetas aún no vistas, extraídas dentro de la página."""
+    try:
+        return tab.evaluate(EXTRACT_NEW_CARDS_JS)
+    except Exception:
+        # Sin JS disponible: volver a parsear la página entera
+        return [{"id": "", "text": t, "date": ""} for t in parse_review_cards(tab.content())]
+
+def collect_reviews(cards, seen, reviews, max_months, known=None):
+    """Añade a `reviews` las tarjetas nuevas y relevantes.
+    
+    `seen` (ReviewDeduper) reconoce una reseña ya recogida aunque vuelva con
+    otro texto; se queda la versión más larga. Devuelve True si hay que
+    parar: demasiadas reseñas antiguas o, en modo incremental, una reseña
+    que ya está en el almacén (`known`, de known_index).
+    """
+    old_count = 0
+    
+    for card in cards:
+        txt = card["text"]
+        if not txt or len(txt) < 30:
+            continue
+        
+        fp = fingerprint(card)
+        pos = seen.find(fp)
+        if pos is not None:
+            # Expandida con "Más", otra fecha relativa...: la misma reseña
+            incr("duplicate_cards")
+            if len(txt) > len(reviews[pos]["text"]):
+                reviews[pos] = card
+                seen.add(fp, pos)
+            continue
+        
+        # Ya guardada: con orden "más recientes", el resto también lo está
+        if known is not None and known.find(fp) is not None:
+            return True
+        
+        # Antigüedad
+        age = parse_review_age_months(card.get("date") or txt)
+        if age > max_months:
+            old_count += 1
+            if old_count >= 5:
+                return True
+            continue
+        
+        # Filtros
+        txt_lower = txt.lower()
+        
+        if any(kw in txt_lower for kw in REVIEW_GOOD_KW) and not any(kw in txt_lower for kw in REVIEW_BAD_KW):
+            seen.add(fp, len(reviews))
+            reviews.append(card)
+    
+    return False
+
 # -------- Scraping de reseñas --------
 def goto_reviews_tab(tab):
-    accept_consent(tab)
-    rnd_sleep(1.0, 1.5)
+    pause(PACER)
+    # is_visible() no espera: primero a que se pinte alguna de las pestañas
+    wait_for(lambda t: tab.locator(", ".join(REVIEWS_TAB_SELECTORS)).first.wait_for(state="visible", timeout=t),
+             TAB_BUTTON_WAIT_MS)
     
-    for sel in ["button[role='tab']:has-text('Reseñas')", "button:has-text('Reseñas')"]:
+    for sel in REVIEWS_TAB_SELECTORS:
         try:
             el = tab.locator(sel)
-            if el.first.is_visible(timeout=3000):
+            if el.first.is_visible():
                 el.first.click()
-                rnd_sleep(2.0, 2.5)
+                wait_for(lambda t: tab.wait_for_selector(REVIEW_CARD_SELECTOR, timeout=t), TAB_WAIT_MS)
                 return True
         except: 
             continue
     return False
 
-def scrape_reviews(tab, max_reviews=200, max_months=12):
-    """Extrae reseñas con scroll agresivo."""
-    if not goto_reviews_tab(tab):
-        return []
-    
-    # Contenedor
-    container = None
-    for sel in ["div[aria-label*='reseñ']", "div[role='main']"]:
+def find_reviews_container(tab):
+    wait_for(lambda t: tab.locator(", ".join(REVIEWS_CONTAINER_SELECTORS)).first.wait_for(state="visible", timeout=t),
+             CONTAINER_WAIT_MS)
+    for sel in REVIEWS_CONTAINER_SELECTORS:
         try:
             loc = tab.locator(sel)
-            if loc.first.is_visible(timeout=2000):
-                container = loc.first
-                break
+            if loc.first.is_visible():
+                return loc.first
         except: 
             continue
+    return tab.locator("body")
+
+def scroll_reviews(tab, container):
+    try:
+        tab.evaluate(SCROLL_JS, container.element_handle())
+    except:
+        tab.evaluate(WINDOW_SCROLL_JS)
+
+def sort_reviews_newest(tab):
+    """Ordena por "Más recientes" (modo incremental: lo ya guardado queda al final)."""
+    try:
+        tab.locator(SORT_BUTTON_SELECTOR).first.click(timeout=3000)
+        tab.locator(SORT_NEWEST_SELECTOR).first.click(timeout=3000)
+        wait_for(lambda t: tab.wait_for_selector(REVIEW_CARD_SELECTOR, timeout=t), TAB_WAIT_MS)
+    except Exception:
+        pass
+
+def scrape_reviews(tab, max_reviews=200, max_months=12, known=None):
+    """Extrae reseñas con scroll agresivo.
     
-    if not container:
-        container = tab.locator("body")
+    Devuelve tarjetas {id, text, date}. Con `known` (claves ya guardadas)
+    ordena por más recientes y para en la primera reseña conocida.
+    """
+    capture = None
+    if REVIEW_SOURCE == "network":
+        capture = ReviewCapture()
+        tab.on("response", capture.on_response)
     
-    seen = set()
+    try:
+        with stage("reviews_tab"):
+            opened = goto_reviews_tab(tab)
+        if not opened:
+            incr("sin_pestana")
+            return []
+    
+        if known is not None:
+            known = known_index(known)
+            with stage("sort"):
+                sort_reviews_newest(tab)
+    
+        container = find_reviews_container(tab)
+    
+        if capture:
+            with stage("network_reviews"):
+                reviews = scrape_reviews_network(tab, container, capture, max_reviews, max_months, known)
+            if reviews is not None:
+                return reviews
+    finally:
+        # También al salir antes (sin pestaña de reseñas) o si algo falla
+        if capture:
+            tab.remove_listener("response", capture.on_response)
+    
+    seen = ReviewDeduper()
     reviews = []
     stale_scrolls = 0
     scroll_count = 0
-    max_scrolls = 50
+    scroll_timeouts = 0
+    cards_seen = 0
     
-    while len(reviews) < max_reviews and stale_scrolls < 10 and scroll_count < max_scrolls:
+    while (len(reviews) < max_reviews and stale_scrolls < MAX_STALE_SCROLLS
+           and scroll_count < MAX_SCROLLS and scroll_timeouts < MAX_SCROLL_TIMEOUTS):
         scroll_count += 1
         
-        # Scroll
-        try:
-            tab.evaluate("(el)=>{el.scrollBy(0, el.scrollHeight)}", container.element_handle())
-        except:
-            tab.evaluate("window.scrollBy(0, window.innerHeight * 3)")
+        incr("scrolls")
         
-        rnd_sleep(1.5, 2.0)
+        # Scroll y espera a que lleguen más tarjetas
+        with stage("scroll"):
+            loaded = tab.evaluate(CARD_COUNT_JS)
+            scroll_reviews(tab, container)
+            if wait_for(lambda t: tab.wait_for_function(MORE_CARDS_JS, arg=loaded, timeout=t), SCROLL_WAIT_MS):
+                scroll_timeouts = 0
+            else:
+                scroll_timeouts += 1
+        pause(PACER)
         
         # Expandir "Ver más"
         if scroll_count % 3 == 0:
-            try:
-                ver_mas = tab.locator("button:has-text('Ver más'), button:has-text('Más')")
-                for i in range(min(ver_mas.count(), 10)):
-                    try:
-                        ver_mas.nth(i).click(timeout=300)
-                        time.sleep(0.2)
-                    except: pass
-            except: pass
+            with stage("ver_mas"):
+                try:
+                    ver_mas = tab.locator(VER_MAS_SELECTOR)
+                    for i in range(min(ver_mas.count(), 10)):
+                        try:
+                            btn = ver_mas.nth(i)
+                            btn.evaluate(MARK_CARD_DIRTY_JS)
+                            btn.click(timeout=300)
+                            incr("ver_mas_clicks")
+                        except: pass
+                except: pass
         
         # Parsear
-        html = tab.content()
-        soup = BeautifulSoup(html, "html.parser")
-        
-        cards = soup.select("div[data-review-id]")
-        if not cards:
-            cards = soup.select("div[jsaction*='review']")
-        if not cards:
-            all_divs = soup.find_all("div")
-            cards = [d for d in all_divs if 50 < len(d.get_text(strip=True)) < 5000]
-        
         before = len(reviews)
-        old_count = 0
-        
-        for card in cards:
-            txt = card.get_text(" ", strip=True)
-            
-            if not txt or len(txt) < 30 or txt in seen:
-                continue
-            
-            # Antigüedad
-            age = parse_review_age_months(txt)
-            if age > max_months:
-                old_count += 1
-                if old_count >= 5:
-                    return reviews
-                continue
-            
-            # Filtros
-            txt_lower = txt.lower()
-            
-            good = ["inmobiliaria", "agente", "casa", "piso", "vivienda", "alquiler", "venta", "compra"]
-            bad = ["coche", "auto", "vehículo", "moto", "taller", "gasolina"]
-            
-            if any(kw in txt_lower for kw in good) and not any(kw in txt_lower for kw in bad):
-                seen.add(txt)
-                reviews.append(txt)
+        with stage("extract_cards"):
+            cards = extract_new_cards(tab)
+        cards_seen += len(cards)
+        if collect_reviews(cards, seen, reviews, max_months, known):
+            return reviews
         
         if len(reviews) == before:
             stale_scrolls += 1
+            incr("stale_scrolls")
         else:
             stale_scrolls = 0
     
+    if not cards_seen:
+        incr("sin_tarjetas")
+    return reviews[:max_reviews]
+
+def scrape_reviews_network(tab, container, capture, max_reviews, max_months, known=None):
+    """Lee las reseñas de las respuestas XHR de Maps en vez del DOM.
+    
+    Cada scroll pide la página siguiente y se espera a su respuesta, sin
+    pausas fijas ni clics en "Más". Devuelve None si no llega ninguna
+    respuesta reconocible, para que el llamador use el DOM.
+    """
+    seen = ReviewDeduper()
+    reviews = []
+    timeouts = 0
+    
+    for _ in range(MAX_SCROLLS):
+        cards = []
+        for resp in capture.take():
+            if resp.status == 429:
+                record_throttle("http_429")
+                continue
+            try:
+                cards += capture.feed(resp.url, resp.text())
+                incr("review_responses")
+            except Exception:
+                pass
+        if collect_reviews(cards, seen, reviews, max_months, known):
+            return reviews
+        
+        if len(reviews) >= max_reviews or (capture.responses and not capture.has_more):
+            break
+        
+        pause(PACER)
+        
+        def next_page(t):
+            with tab.expect_response(lambda r: is_review_rpc(r.url), timeout=t):
+                scroll_reviews(tab, container)
+        
+        if wait_for(next_page, NETWORK_WAIT_MS):
+            timeouts = 0
+        else:
+            if not capture.responses and not capture.pending:
+                return None
+            timeouts += 1
+            if timeouts >= 3:
+                break
+    
     return reviews[:max_reviews]
 
 # -------- Procesamiento --------
-def process_reviews_for_agents(reviews):
+def clean_review_text(review):
+    return re.sub(r'\s+', ' ', review.strip())
+
+def spacy_model_version():
+    """Versión del modelo sin cargarlo (la del paquete instalado), si se puede."""
+    if nlp is None:
+        try:
+            return importlib.metadata.version(SPACY_MODEL)
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return get_nlp().meta.get("version")
+
+def extraction_rules_version():
+    """Huella del modelo y de las reglas: si cambia, la caché de extracción no vale."""
+    h = hashlib.sha1()
+    for part in (
+        SPACY_MODEL, spacy_model_version(), SPACY_EXCLUDE, EXTRACTION_RULES_REV,
+        sorted(NOMBRES_COMUNES_ESPANOL), sorted(EXCLUDED_NAME_WORDS), NAME_PATTERNS,
+        NER_ARTICLE_RE.pattern, PATTERN_ARTICLE_RE.pattern,
+        AGENT_CONTEXT_BEFORE, AGENT_CONTEXT_AFTER,
+    ):
+        h.update(repr(part).encode("utf-8"))
+    return h.hexdigest()
+
+_extraction_cache = None
+
+def get_extraction_cache():
+    global _extraction_cache
+    if _extraction_cache is None and EXTRACTION_CACHE_DB:
+        _extraction_cache = ExtractionCache(EXTRACTION_CACHE_DB, extraction_rules_version(), EXTRACTION_CACHE_MAX)
+    return _extraction_cache
+
+def review_agents(reviews, ner_names=None):
+    """Agentes validados de cada reseña (una lista por reseña, en el mismo orden).
+    
+    Las reseñas ya vistas salen de la caché de extracción; el resto pasa por
+    NER en lote, salvo que se pase ya calculado en `ner_names` (una lista
+    por reseña).
+    """
+    with stage("clean"):
+        clean_reviews = [clean_review_text(r) for r in reviews]
+        hashes = [text_hash(c) for c in clean_reviews]
+    
+    cache = get_extraction_cache()
+    with stage("cache_lookup"):
+        cached = cache.get_many(hashes) if cache else {}
+    todo = [i for i, h in enumerate(hashes) if h not in cached]
+    
+    with stage("ner"):
+        if ner_names is None:
+            todo_ner = batch_person_names([clean_reviews[i] for i in todo])
+        else:
+            todo_ner = [ner_names[i] for i in todo]
+    incr("reviews_ner", len(todo))
+    
+    fresh = {}
+    with stage("match_names"):
+        for i, names in zip(todo, todo_ner):
+            clean_review = clean_reviews[i]
+            agent_names = extract_names_from_text(clean_review, ner_names=names)
+            fresh[hashes[i]] = [a for a in agent_names if is_likely_agent_name(a, clean_review)]
+    
+    if cache and fresh:
+        with stage("cache_store"):
+            cache.put_many(fresh.items())
+    
+    return [cached[h] if h in cached else fresh[h] for h in hashes]
+
+def group_mentions(reviews, agents_per_review):
+    """Reseñas con agentes y testimonios por agente."""
     processed_reviews = []
     agent_mentions = defaultdict(list)
     
-    for review in reviews:
-        clean_review = re.sub(r'\s+', ' ', review.strip())
-        agent_names = extract_names_from_text(clean_review)
-        
-        validated_agents = [a for a in agent_names if is_likely_agent_name(a, clean_review)]
-        
+    for review, validated_agents in zip(reviews, agents_per_review):
         if validated_agents:
+            clean_review = clean_review_text(review)
             processed_reviews.append({
                 "text": clean_review,
                 "agents_mentioned": validated_agents,
@@ -346,27 +820,61 @@ def process_reviews_for_agents(reviews):
     
     return processed_reviews, agent_mentions
 
-def group_similar(name_counts, cutoff=85):
+def process_reviews_for_agents(reviews, ner_names=None):
+    """Agentes mencionados en las reseñas de una agencia."""
+    return group_mentions(reviews, review_agents(reviews, ner_names))
+
+def cluster_names(names, cutoff=None):
+    """Agrupa nombres similares: componentes conexas del grafo de similitud.
+    
+    La matriz se calcula con rapidfuzz.cdist por bloques de filas y las
+    aristas (score >= cutoff) se unen con union-find. Devuelve listas de
+    índices en el orden de `names`.
+    """
+    import numpy as np
+    from rapidfuzz import fuzz, process
+    
+    if cutoff is None:
+        cutoff = CLUSTER_CUTOFF
+    n = len(names)
+    parent = list(range(n))
+    
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    for start in range(0, n, CLUSTER_BLOCK):
+        scores = process.cdist(
+            names[start:start + CLUSTER_BLOCK], names,
+            scorer=fuzz.token_sort_ratio,
+            score_cutoff=cutoff,
+            dtype=np.uint8,
+            workers=CLUSTER_WORKERS,
+        )
+        rows, cols = np.nonzero(scores)
+        rows += start
+        upper = cols > rows  # la matriz es simétrica
+        for i, j in zip(rows[upper].tolist(), cols[upper].tolist()):
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+    
+    clusters = defaultdict(list)
+    for i in range(n):
+        clusters[find(i)].append(i)
+    return list(clusters.values())
+
+def group_similar(name_counts, cutoff=None):
     names = list(name_counts.keys())
     counts = dict(name_counts)
-    used = set()
     groups = []
     
-    for name in names:
-        if name in used:
-            continue
-        
-        matches = process.extract(
-            name, 
-            [n for n in names if n not in used],
-            scorer=fuzz.token_sort_ratio, 
-            score_cutoff=cutoff, 
-            limit=100
-        )
-        
-        group_names = [m[0] for m in matches]
-        for gn in group_names:
-            used.add(gn)
+    with stage("cluster_names"):
+        clusters = cluster_names(names, cutoff)
+    for members in clusters:
+        group_names = [names[i] for i in members]
         
         total = sum(counts.get(g, 0) for g in group_names)
         canonical = max(group_names, key=len)
@@ -379,42 +887,364 @@ def group_similar(name_counts, cutoff=85):
     
     return sorted(groups, key=lambda x: x["count"], reverse=True)
 
+def global_agent_names(aggregated, cutoff=None):
+    """Enlaza el mismo agente en distintas agencias (p. ej. dos oficinas de una marca).
+    
+    Recorre las agencias una vez y devuelve el nombre canónico común de cada
+    agente y el ranking global: [(nombre, menciones, [agencias])].
+    """
+    mentions = Counter()
+    agencies = defaultdict(list)
+    for a in aggregated:
+        for agent in a["agentes_inmobiliarios"]:
+            mentions[agent["nombre_agente"]] += agent["total_menciones"]
+            if a["agency_name"] not in agencies[agent["nombre_agente"]]:
+                agencies[agent["nombre_agente"]].append(a["agency_name"])
+    
+    names = list(mentions)
+    canonical = {}
+    totals = Counter()
+    linked = defaultdict(list)
+    for members in cluster_names(names, cutoff):
+        group_names = [names[i] for i in members]
+        name = max(group_names, key=len)
+        for g in group_names:
+            canonical[g] = name
+            totals[name] += mentions[g]
+            linked[name].extend(x for x in agencies[g] if x not in linked[name])
+    
+    return canonical, [(name, count, linked[name]) for name, count in totals.most_common()]
+
+def annotate_global_agents(aggregated, canonical):
+    """Añade "agente_global" a cada agente según global_agent_names."""
+    for a in aggregated:
+        for agent in a["agentes_inmobiliarios"]:
+            agent["agente_global"] = canonical[agent["nombre_agente"]]
+        yield a
+
 # -------- Scraping de agencia --------
-def scrape_single_agency(url, max_reviews, max_months):
-    """Scrapea una agencia desde su URL."""
+def agency_result(agency, url, cards, stats):
+    return {
+        "agency_name": agency,
+        "agency_url": url,
+        "reviews": [c["text"] for c in cards],
+        "review_keys": [review_key(c.get("id"), c["text"]) for c in cards],
+        "stats": stats.as_dict(),
+    }
+
+def scrape_agency_tab(tab, url, max_reviews, max_months, known=None):
+    """Scrapea una agencia en una pestaña ya abierta."""
+    stats = start_agency_stats()
+    set_agency(url)
+    tab.on("response", response_size)
+    
     try:
-        with sync_playwright() as pw:
-            browser = pw.chromium.launch(headless=HEADLESS)
-            ctx = browser.new_context(user_agent=random.choice(USER_AGENTS))
-            tab = ctx.new_page()
-            
-            tab.goto(url, timeout=60000)
-            accept_consent(tab)
-            wait_network_quiet(tab)
-            rnd_sleep(1.0, 1.5)
+        with stage("agency"):
+            with stage("goto"), waiting():
+                response = tab.goto(url, timeout=60000)
+            reason = throttle_signal(tab, response)
+            if reason:
+                # Ni consentimiento ni reseñas: la agencia solo cuenta como frenada
+                record_throttle(reason)
+                return agency_result(url, url, [], stats)
+            with stage("consent"):
+                accept_consent(tab)
+            with stage("wait_page"):
+                if not wait_for(lambda t: tab.wait_for_selector("h1", timeout=t), PAGE_WAIT_MS):
+                    incr("sin_pagina")
             
             # Nombre
-            soup = BeautifulSoup(tab.content(), "html.parser")
-            name_el = soup.select_one("h1") or soup.select_one("h2")
-            agency = name_el.get_text(strip=True) if name_el else "SinNombre"
+            with stage("parse_name"):
+                agency = agency_name(tab)
             
             # Reseñas
-            reviews = scrape_reviews(tab, max_reviews, max_months)
-            
-            browser.close()
-            
-            return {
-                "agency_name": agency,
-                "agency_url": url,
-                "reviews": reviews
-            }
+            with stage("reviews"):
+                cards = scrape_reviews(tab, max_reviews, max_months, known)
+    finally:
+        tab.remove_listener("response", response_size)
+    incr("agencies")
+    
+    return agency_result(agency, url, cards, stats)
+
+def scrape_single_agency(url, max_reviews, max_months, tab=None, known=None):
+    """Scrapea una agencia desde su URL (con navegador propio si no se da `tab`)."""
+    try:
+        if tab is not None:
+            return scrape_agency_tab(tab, url, max_reviews, max_months, known)
+        
+        from playwright.sync_api import sync_playwright
+        from browser_pool import load_consent, route_blocked, save_consent
+        with sync_playwright() as pw:
+            browser = pw.chromium.launch(headless=HEADLESS)
+            ctx = browser.new_context(user_agent=random.choice(USER_AGENTS),
+                                      storage_state=load_consent(CONSENT_STATE_JSON))
+            if BLOCK_RESOURCES:
+                ctx.route("**/*", route_blocked)
+            try:
+                result = scrape_agency_tab(ctx.new_page(), url, max_reviews, max_months, known)
+                save_consent(ctx.storage_state(), CONSENT_STATE_JSON)
+                return result
+            finally:
+                browser.close()
     except Exception as e:
         print(f"✗ Error en {url}: {e}")
+        incr("agency_errors")
+        return None
+
+# -------- Motor asíncrono --------
+async def wait_for_async(condition, timeout):
+    """Versión asyncio de wait_for: `condition(timeout)` devuelve una corrutina."""
+    from playwright.async_api import TimeoutError as AsyncPWTimeout
+    t0 = time.perf_counter()
+    timed_out = False
+    with waiting():
+        try:
+            await condition(timeout)
+        except AsyncPWTimeout:
+            timed_out = True
+            record_timeout()
+            incr("timeouts")
+    PACER.observe(time.perf_counter() - t0, timed_out)
+    return not timed_out
+
+async def accept_consent_async(page):
+    if "consent." not in page.url and consent_given(await page.context.cookies()):
+        return
+    if "consent." in page.url:
+        await wait_for_async(
+            lambda t: page.locator(", ".join(CONSENT_SELECTORS)).first.wait_for(state="visible", timeout=t),
+            CONSENT_WAIT_MS)
+    
+    for sel in CONSENT_SELECTORS:
+        try:
+            btn = page.locator(sel).first
+            if await btn.is_visible():
+                await btn.click()
+                await page.wait_for_load_state()
+                return
+        except: pass
+
+async def agency_name_async(tab):
+    try:
+        return await tab.evaluate(AGENCY_NAME_JS)
+    except Exception:
+        return parse_agency_name(await tab.content())
+
+async def extract_new_cards_async(tab):
+    try:
+        return await tab.evaluate(EXTRACT_NEW_CARDS_JS)
+    except Exception:
+        return [{"id": "", "text": t, "date": ""} for t in parse_review_cards(await tab.content())]
+
+async def goto_reviews_tab_async(tab):
+    await pause_async(PACER)
+    await wait_for_async(
+        lambda t: tab.locator(", ".join(REVIEWS_TAB_SELECTORS)).first.wait_for(state="visible", timeout=t),
+        TAB_BUTTON_WAIT_MS)
+    
+    for sel in REVIEWS_TAB_SELECTORS:
+        try:
+            el = tab.locator(sel)
+            if await el.first.is_visible():
+                await el.first.click()
+                await wait_for_async(lambda t: tab.wait_for_selector(REVIEW_CARD_SELECTOR, timeout=t), TAB_WAIT_MS)
+                return True
+        except: 
+            continue
+    return False
+
+async def find_reviews_container_async(tab):
+    await wait_for_async(
+        lambda t: tab.locator(", ".join(REVIEWS_CONTAINER_SELECTORS)).first.wait_for(state="visible", timeout=t),
+        CONTAINER_WAIT_MS)
+    for sel in REVIEWS_CONTAINER_SELECTORS:
+        try:
+            loc = tab.locator(sel)
+            if await loc.first.is_visible():
+                return loc.first
+        except: 
+            continue
+    return tab.locator("body")
+
+async def scroll_reviews_async(tab, container):
+    try:
+        await tab.evaluate(SCROLL_JS, await container.element_handle())
+    except:
+        await tab.evaluate(WINDOW_SCROLL_JS)
+
+async def sort_reviews_newest_async(tab):
+    try:
+        await tab.locator(SORT_BUTTON_SELECTOR).first.click(timeout=3000)
+        await tab.locator(SORT_NEWEST_SELECTOR).first.click(timeout=3000)
+        await wait_for_async(lambda t: tab.wait_for_selector(REVIEW_CARD_SELECTOR, timeout=t), TAB_WAIT_MS)
+    except Exception:
+        pass
+
+async def scrape_reviews_async(tab, max_reviews=200, max_months=12, known=None):
+    """Versión asyncio de scrape_reviews."""
+    capture = None
+    if REVIEW_SOURCE == "network":
+        capture = ReviewCapture()
+        tab.on("response", capture.on_response)
+    
+    try:
+        with stage("reviews_tab"):
+            opened = await goto_reviews_tab_async(tab)
+        if not opened:
+            incr("sin_pestana")
+            return []
+    
+        if known is not None:
+            known = known_index(known)
+            with stage("sort"):
+                await sort_reviews_newest_async(tab)
+    
+        container = await find_reviews_container_async(tab)
+    
+        if capture:
+            with stage("network_reviews"):
+                reviews = await scrape_reviews_network_async(tab, container, capture, max_reviews, max_months, known)
+            if reviews is not None:
+                return reviews
+    finally:
+        # También al salir antes (sin pestaña de reseñas) o si algo falla
+        if capture:
+            tab.remove_listener("response", capture.on_response)
+    
+    seen = ReviewDeduper()
+    reviews = []
+    stale_scrolls = 0
+    scroll_count = 0
+    scroll_timeouts = 0
+    cards_seen = 0
+    
+    while (len(reviews) < max_reviews and stale_scrolls < MAX_STALE_SCROLLS
+           and scroll_count < MAX_SCROLLS and scroll_timeouts < MAX_SCROLL_TIMEOUTS):
+        scroll_count += 1
+        
+        incr("scrolls")
+        
+        # Scroll y espera a que lleguen más tarjetas
+        with stage("scroll"):
+            loaded = await tab.evaluate(CARD_COUNT_JS)
+            await scroll_reviews_async(tab, container)
+            if await wait_for_async(lambda t: tab.wait_for_function(MORE_CARDS_JS, arg=loaded, timeout=t), SCROLL_WAIT_MS):
+                scroll_timeouts = 0
+            else:
+                scroll_timeouts += 1
+        await pause_async(PACER)
+        
+        # Expandir "Ver más"
+        if scroll_count % 3 == 0:
+            with stage("ver_mas"):
+                try:
+                    ver_mas = tab.locator(VER_MAS_SELECTOR)
+                    for i in range(min(await ver_mas.count(), 10)):
+                        try:
+                            btn = ver_mas.nth(i)
+                            await btn.evaluate(MARK_CARD_DIRTY_JS)
+                            await btn.click(timeout=300)
+                            incr("ver_mas_clicks")
+                        except: pass
+                except: pass
+        
+        # Parsear
+        before = len(reviews)
+        with stage("extract_cards"):
+            cards = await extract_new_cards_async(tab)
+        cards_seen += len(cards)
+        if collect_reviews(cards, seen, reviews, max_months, known):
+            return reviews
+        
+        if len(reviews) == before:
+            stale_scrolls += 1
+            incr("stale_scrolls")
+        else:
+            stale_scrolls = 0
+    
+    if not cards_seen:
+        incr("sin_tarjetas")
+    return reviews[:max_reviews]
+
+async def scrape_reviews_network_async(tab, container, capture, max_reviews, max_months, known=None):
+    seen = ReviewDeduper()
+    reviews = []
+    timeouts = 0
+    
+    for _ in range(MAX_SCROLLS):
+        cards = []
+        for resp in capture.take():
+            if resp.status == 429:
+                record_throttle("http_429")
+                continue
+            try:
+                cards += capture.feed(resp.url, await resp.text())
+                incr("review_responses")
+            except Exception:
+                pass
+        if collect_reviews(cards, seen, reviews, max_months, known):
+            return reviews
+        
+        if len(reviews) >= max_reviews or (capture.responses and not capture.has_more):
+            break
+        
+        await pause_async(PACER)
+        
+        async def next_page(t):
+            async with tab.expect_response(lambda r: is_review_rpc(r.url), timeout=t):
+                await scroll_reviews_async(tab, container)
+        
+        if await wait_for_async(next_page, NETWORK_WAIT_MS):
+            timeouts = 0
+        else:
+            if not capture.responses and not capture.pending:
+                return None
+            timeouts += 1
+            if timeouts >= 3:
+                break
+    
+    return reviews[:max_reviews]
+
+async def scrape_single_agency_async(tab, url, max_reviews, max_months, known=None):
+    """Versión asyncio de scrape_single_agency sobre una pestaña del pool."""
+    try:
+        stats = start_agency_stats()
+        set_agency(url)
+        tab.on("response", response_size)
+        
+        try:
+            with stage("agency"):
+                with stage("goto"), waiting():
+                    response = await tab.goto(url, timeout=60000)
+                reason = throttle_signal(tab, response)
+                if reason:
+                    record_throttle(reason)
+                    return agency_result(url, url, [], stats)
+                with stage("consent"):
+                    await accept_consent_async(tab)
+                with stage("wait_page"):
+                    if not await wait_for_async(lambda t: tab.wait_for_selector("h1", timeout=t), PAGE_WAIT_MS):
+                        incr("sin_pagina")
+                
+                with stage("parse_name"):
+                    agency = await agency_name_async(tab)
+                with stage("reviews"):
+                    cards = await scrape_reviews_async(tab, max_reviews, max_months, known)
+        finally:
+            tab.remove_listener("response", response_size)
+        incr("agencies")
+        
+        return agency_result(agency, url, cards, stats)
+    except Exception as e:
+        print(f"✗ Error en {url}: {e}")
+        incr("agency_errors")
         return None
 
 # -------- Reportes --------
-def generate_html(data):
-    html = [
+# Todos los escritores consumen un iterable de agencias una sola vez, así que
+# funcionan igual con una lista que leyendo del JSONL línea a línea.
+def iter_html(data):
+    yield from [
         "<!doctype html><html><head><meta charset='utf-8'>",
         "<title>Agentes Inmobiliarios</title>",
         "<style>",
@@ -428,133 +1258,849 @@ def generate_html(data):
     ]
     
     for a in data:
-        html.append(f"<div class='agency'>")
-        html.append(f"<h2>{a['agency_name']}</h2>")
-        html.append(f"<p>📊 {a['total_reviews']} reseñas | 👥 {a['reviews_with_agents']} con agentes</p>")
-        html.append(f"<p><a href='{a['agency_url']}' target='_blank'>Ver en Google Maps</a></p>")
+        yield f"<div class='agency'>"
+        yield f"<h2>{a['agency_name']}</h2>"
+        yield f"<p>📊 {a['total_reviews']} reseñas | 👥 {a['reviews_with_agents']} con agentes</p>"
+        yield f"<p><a href='{a['agency_url']}' target='_blank'>Ver en Google Maps</a></p>"
         
         for agent in a.get('agentes_inmobiliarios', [])[:10]:
-            html.append(f"<div class='agent-card'>")
-            html.append(f"<h3>🏆 {agent['nombre_agente']} ({agent['total_menciones']} menciones)</h3>")
+            yield f"<div class='agent-card'>"
+            yield f"<h3>🏆 {agent['nombre_agente']} ({agent['total_menciones']} menciones)</h3>"
             for t in agent['testimonios_clientes'][:3]:
-                html.append(f"<div class='testimonial'>{t['testimonio'][:300]}...</div>")
-            html.append("</div>")
+                yield f"<div class='testimonial'>{t['testimonio'][:300]}...</div>"
+            yield "</div>"
         
-        html.append("</div>")
-    
-    return "\n".join(html) + "</body></html>"
+        yield "</div>"
 
-def generate_excel(data, filename):
-    rows = []
+def generate_html(data):
+    return "\n".join(iter_html(data)) + "</body></html>"
+
+def write_html(data, filename):
+    """Como generate_html, pero escribiendo según se genera."""
+    with open(filename, "w", encoding="utf-8") as f:
+        for i, chunk in enumerate(iter_html(data)):
+            if i:
+                f.write("\n")
+            f.write(chunk)
+        f.write("</body></html>")
+
+def write_json(data, filename):
+    """Mismo fichero que json.dumps(list(data), indent=2), agencia a agencia."""
+    with open(filename, "w", encoding="utf-8") as f:
+        count = 0
+        for a in data:
+            f.write(",\n" if count else "[\n")
+            f.write("\n".join("  " + line for line in json.dumps(a, ensure_ascii=False, indent=2).split("\n")))
+            count += 1
+        f.write("\n]" if count else "[]")
+
+EXCEL_HEADER = ['Agencia', 'Agente', 'Menciones', 'Testimonio']
+
+def excel_rows(data):
     for agency in data:
         for agent in agency.get('agentes_inmobiliarios', []):
             for t in agent['testimonios_clientes']:
-                rows.append({
-                    'Agencia': agency['agency_name'],
-                    'Agente': agent['nombre_agente'],
-                    'Menciones': agent['total_menciones'],
-                    'Testimonio': t['testimonio']
-                })
-    
-    if rows:
-        df = pd.DataFrame(rows)
-        df.to_excel(filename, index=False, engine='openpyxl')
-        print(f"✅ Excel: {filename} ({len(rows)} registros)")
+                yield [agency['agency_name'], agent['nombre_agente'], agent['total_menciones'], t['testimonio']]
+
+def generate_excel(data, filename):
+    """Una fila por testimonio, escrita según se genera (openpyxl write-only).
+    
+    Mismo contenido y cabecera que el DataFrame.to_excel de antes; si no hay
+    filas no se crea el fichero.
+    """
+    rows = excel_rows(data)
+    first = next(rows, None)
+    if first is None:
+        return
+    
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Font, Side
+    
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    # Estilo de cabecera de pandas
+    thin = Side(style="thin")
+    header = []
+    for title in EXCEL_HEADER:
+        cell = WriteOnlyCell(ws, value=title)
+        cell.font = Font(bold=True)
+        cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        cell.alignment = Alignment(horizontal="center", vertical="top")
+        header.append(cell)
+    ws.append(header)
+    
+    ws.append(first)
+    count = 1
+    for row in rows:
+        ws.append(row)
+        count += 1
+    wb.save(filename)
+    print(f"✅ Excel: {filename} ({count} registros)")
+
+PARQUET_SCHEMAS = {
+    "agencias": [("agency_name", "string"), ("agency_url", "string"), ("total_reviews", "int32"),
+                 ("reviews_with_agents", "int32"), ("agentes", "int32")],
+    "agentes": [("agency_url", "string"), ("nombre_agente", "string"), ("total_menciones", "int32"),
+                ("variantes_nombre", "list<string>"), ("agente_global", "string")],
+    "testimonios": [("agency_url", "string"), ("nombre_agente", "string"), ("testimonio", "string")],
+}
+
+def parquet_rows(agency):
+    """Filas de cada tabla para una agencia: {tabla: [dict]}."""
+    agents = agency.get('agentes_inmobiliarios', [])
+    url = agency['agency_url']
+    return {
+        "agencias": [{
+            "agency_name": agency['agency_name'], "agency_url": url,
+            "total_reviews": agency['total_reviews'], "reviews_with_agents": agency['reviews_with_agents'],
+            "agentes": len(agents),
+        }],
+        "agentes": [{
+            "agency_url": url, "nombre_agente": agent['nombre_agente'],
+            "total_menciones": agent['total_menciones'], "variantes_nombre": agent['variantes_nombre'],
+            "agente_global": agent.get('agente_global'),
+        } for agent in agents],
+        "testimonios": [{
+            "agency_url": url, "nombre_agente": agent['nombre_agente'], "testimonio": t['testimonio'],
+        } for agent in agents for t in agent['testimonios_clientes']],
+    }
+
+def generate_parquet(data, pattern):
+    """Agencias, agentes y testimonios en tres Parquet, por grupos de PARQUET_BATCH filas."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:  # Solo hace falta para --parquet
+        print("⚠️  Parquet: falta pyarrow (pip install pyarrow)")
+        return
+    
+    types = {"string": pa.string(), "int32": pa.int32(), "list<string>": pa.list_(pa.string())}
+    schemas = {table: pa.schema([(name, types[kind]) for name, kind in cols])
+               for table, cols in PARQUET_SCHEMAS.items()}
+    writers = {table: pq.ParquetWriter(pattern.format(table=table), schema) for table, schema in schemas.items()}
+    pending = {table: [] for table in schemas}
+    counts = Counter()
+    
+    def flush(table):
+        writers[table].write_table(pa.Table.from_pylist(pending[table], schema=schemas[table]))
+        counts[table] += len(pending[table])
+        pending[table] = []
+    
+    try:
+        for agency in data:
+            for table, rows in parquet_rows(agency).items():
+                pending[table].extend(rows)
+                if len(pending[table]) >= PARQUET_BATCH:
+                    flush(table)
+        for table in schemas:
+            if pending[table]:
+                flush(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    
+    print(f"✅ Parquet: {pattern.format(table='*')} "
+          f"({', '.join(f'{counts[t]} {t}' for t in schemas)})")
 
 # -------- MAIN --------
-def run_all():
+def print_timing(results):
+    """Tiempo por agencia: trabajando vs esperando a la página vs pausas."""
+    totals = Counter()
+    for r in results:
+        st = r.get("stats")
+        if not st:
+            continue
+        if not totals:
+            print("\n⏳ TIEMPOS POR AGENCIA (trabajo / espera / pausas):")
+        totals.update({k: v for k, v in st.items() if isinstance(v, (int, float))})
+        if st.get("throttle"):
+            totals["throttled"] += 1
+        print(f"   {r['agency_name'][:40]:40} {st['work_s']:6.1f}s / {st['wait_s']:6.1f}s / {st['pause_s']:6.1f}s"
+              f"  ({st['timeouts']} timeouts)" + (f" ⚠️ {st['throttle']}" if st.get("throttle") else ""))
+    if not totals:
+        return
+    print(f"   {'TOTAL':40} {totals['work_s']:6.1f}s / {totals['wait_s']:6.1f}s / {totals['pause_s']:6.1f}s"
+          f"  ({totals['timeouts']} timeouts, {totals['throttled']} frenadas)")
+    print(f"   Pausa de cortesía actual: {PACER.delay:.2f}s")
+
+def throttle_reason(result):
+    """Por qué reintentar un resultado: "error" si no lo hay, la señal de bloqueo de Maps o None."""
+    if not result:
+        return "error"
+    return result.get("stats", {}).get("throttle")
+
+def rate_limiter():
+    return TokenBucket(AGENCIES_PER_MINUTE / 60, burst=MAX_WORKERS) if AGENCIES_PER_MINUTE else None
+
+def retry_or_result(url, result, reason, attempts, retry):
+    """El resultado, o `retry(espera)` si falló o Maps lo frenó (`reason`) y quedan reintentos.
+    
+    El pool devuelve la URL a su cola con esa espera (exponencial, con
+    jitter): el reintento usa un contexto nuevo y, si el navegador se cayó,
+    uno relanzado. Es la única capa de reintentos: lo que siga sin
+    resultado o frenado tras MAX_RETRIES se da por perdido (en la cola de
+    trabajo, como fallido) en vez de volver a repartirse.
+    """
+    if reason is None or attempts[url] >= MAX_RETRIES:
+        return result
+    incr("retries")
+    incr(f"throttle_{reason}")
+    attempts[url] += 1
+    return retry(backoff_delay(attempts[url] - 1, RETRY_BASE_DELAY))
+
+def url_count(urls):
+    """Para la barra de progreso: None si las URLs llegan de un generador."""
+    return len(urls) if hasattr(urls, "__len__") else None
+
+def show_limits(limiter, bar):
+    set_gauge("concurrency", limiter.concurrency)
+    set_gauge("error_rate", round(limiter.error_rate, 3))
+    bar.set_postfix(concurrencia=limiter.concurrency, errores=f"{limiter.error_rate:.0%}")
+
+def crawl_threads(urls, sink, known=None, failed=None):
+    """Scrapea con navegadores reutilizables, uno por hilo.
+    
+    `urls` se consume según quedan navegadores libres (puede ser un
+    generador, como leased_urls). Cada resultado se entrega a `sink` en
+    cuanto termina; `failed(url)` recibe las que siguen sin resultado tras
+    los reintentos. `known` (modo incremental) son las claves guardadas por
+    URL de agencia.
+    """
+    if MAX_WORKERS > 1:
+        print(f"⚡ Procesamiento paralelo ({MAX_WORKERS} navegadores)")
+    else:
+        print("⏳ Procesamiento secuencial")
+    
+    from browser_pool import BrowserPool, Retry
+    
+    pool = BrowserPool(
+        browsers=MAX_WORKERS,
+        recycle_after=BROWSER_RECYCLE_AFTER,
+        headless=HEADLESS,
+        user_agents=USER_AGENTS,
+        block_resources=BLOCK_RESOURCES,
+        consent_state=CONSENT_STATE_JSON,
+    )
+    limiter = AdaptiveConcurrency(MAX_WORKERS, minimum=min(MIN_WORKERS, MAX_WORKERS), maximum=MAX_WORKERS)
+    bucket = rate_limiter()
+    attempts = Counter()
+    
+    def scrape(tab, url):
+        with limiter.slot():
+            if bucket:
+                bucket.acquire()
+            result = scrape_single_agency(
+                url, MAX_REVIEWS_PER_AGENCY, MAX_MONTHS_OLD, tab=tab, known=known[url] if known is not None else None)
+        reason = throttle_reason(result)
+        limiter.record(reason is None)
+        result = retry_or_result(url, result, reason, attempts, Retry)
+        if not result and failed:
+            failed(url)
+        return result
+    
+    with tqdm(pool.imap(scrape, urls), total=url_count(urls), desc="Agencias") as bar:
+        for result in bar:
+            show_limits(limiter, bar)
+            if result:
+                sink(result)
+    
+    print(pool.summary())
+
+async def crawl_async(urls, sink, known=None, failed=None):
+    """Scrapea con asyncio: muchas pestañas en un solo hilo."""
+    from browser_pool import AsyncBrowserPool, Retry
+    
+    pool = AsyncBrowserPool(
+        browsers=MAX_WORKERS,
+        pages_per_browser=PAGES_PER_BROWSER,
+        recycle_after=BROWSER_RECYCLE_AFTER,
+        headless=HEADLESS,
+        user_agents=USER_AGENTS,
+        block_resources=BLOCK_RESOURCES,
+        consent_state=CONSENT_STATE_JSON,
+    )
+    print(f"⚡ Procesamiento asíncrono ({pool.concurrency} pestañas en {MAX_WORKERS} navegadores)")
+    limiter = AsyncAdaptiveConcurrency(pool.concurrency, minimum=min(MIN_WORKERS, pool.concurrency),
+                                       maximum=pool.concurrency)
+    bucket = rate_limiter()
+    attempts = Counter()
+    
+    async def scrape(tab, url):
+        async with limiter.slot():
+            if bucket:
+                await bucket.acquire_async()
+            result = await scrape_single_agency_async(
+                tab, url, MAX_REVIEWS_PER_AGENCY, MAX_MONTHS_OLD, known=known[url] if known is not None else None)
+        reason = throttle_reason(result)
+        await limiter.record(reason is None)
+        result = retry_or_result(url, result, reason, attempts, Retry)
+        if not result and failed:
+            await loop.run_in_executor(None, failed, url)
+        return result
+    
+    loop = asyncio.get_running_loop()
+    with tqdm(total=url_count(urls), desc="Agencias") as bar:
+        async for result in pool.imap(scrape, urls):
+            bar.update(1)
+            show_limits(limiter, bar)
+            if result:
+                # `sink` puede bloquear (cola del pipeline llena): fuera del bucle de eventos
+                await loop.run_in_executor(None, sink, result)
+    
+    print(pool.summary())
+
+def recent_reviews(rows, max_reviews, max_months, now=None):
+    """Las reseñas guardadas (de agency_reviews) que entrarían hoy en un crawl completo.
+    
+    Su edad es la fecha relativa del texto ("hace 3 meses") al guardarla más
+    lo que ha pasado desde `first_seen`. Se quedan las `max_reviews` más
+    recientes, en el orden del almacén.
+    """
+    now = time.time() if now is None else now
+    ages = [(now - first_seen) / (30 * 86400) + parse_review_age_months(text) for _, text, _, first_seen in rows]
+    keep = sorted((i for i, age in enumerate(ages) if age <= max_months), key=ages.__getitem__)[:max_reviews]
+    return [rows[i] for i in sorted(keep)]
+
+def agency_job(a, store, incremental=False):
+    """Lo que necesita extract_agency de una agencia ya guardada en `store`.
+    
+    En modo incremental son las reseñas guardadas que aún entran en
+    MAX_MONTHS_OLD y MAX_REVIEWS_PER_AGENCY, con los agentes ya extraídos
+    (None en las pendientes); si no, las del scraping.
+    """
+    job = {"agency_name": a["agency_name"], "agency_url": a["agency_url"]}
+    if not incremental:
+        return dict(job, reviews=a["reviews"], review_keys=a["review_keys"]), None
+    
+    rows = recent_reviews(store.agency_reviews(a["agency_url"]), MAX_REVIEWS_PER_AGENCY, MAX_MONTHS_OLD)
+    job["reviews"] = [text for _, text, _, _ in rows]
+    job["review_keys"] = [key for key, _, _, _ in rows]
+    return job, [agents for _, _, agents, _ in rows]
+
+def extract_agency(job, agents=None):
+    """Agentes de una agencia: NER de las reseñas sin agentes + agrupado.
+    
+    Puede correr en otro proceso. Devuelve (agentes por reseña, datos de la
+    agencia o None si no tiene reseñas, (aciertos, fallos) de caché).
+    """
+    set_agency(job["agency_url"])
+    reviews = job["reviews"]
+    agents = list(agents) if agents else [None] * len(reviews)
+    
+    cache = get_extraction_cache()
+    before = (cache.hits, cache.misses) if cache else (0, 0)
+    todo = [i for i, found in enumerate(agents) if found is None]
+    for i, found in zip(todo, review_agents([reviews[i] for i in todo])):
+        agents[i] = found
+    cache_counts = (cache.hits - before[0], cache.misses - before[1]) if cache else (0, 0)
+    
+    if not reviews:
+        return agents, None, cache_counts
+    
+    processed_reviews, agent_mentions = group_mentions(reviews, agents)
+    
+    all_agent_names = []
+    for review in processed_reviews:
+        all_agent_names.extend(review["agents_mentioned"])
+    
+    counts = Counter(all_agent_names)
+    grouped = group_similar(counts)
+    
+    return agents, {
+        "agency_name": job["agency_name"],
+        "agency_url": job["agency_url"],
+        "total_reviews": len(reviews),
+        "reviews_with_agents": len(processed_reviews),
+        "agentes_inmobiliarios": [
+            {
+                "nombre_agente": agent["canonical"],
+                "total_menciones": agent["count"],
+                "variantes_nombre": agent["variants"],
+                "testimonios_clientes": [
+                    {"testimonio": t} 
+                    for t in agent_mentions.get(agent["canonical"], [])[:5]
+                ]
+            }
+            for agent in grouped
+        ]
+    }, cache_counts
+
+def extract_agency_remote(job, agents=None):
+    """extract_agency para el pool: añade las métricas del proceso."""
+    return (*extract_agency(job, agents), METRICS.drain())
+
+def _init_nlp_worker(config):
+    """Inicializador de los procesos de extracción: copia la config de la CLI."""
+    METRICS.trace = config.pop("TRACE_JSON") is not None
+    globals().update(config)
+
+def nlp_worker_config():
+    return {
+        "NER_BATCH_SIZE": NER_BATCH_SIZE,
+        "NER_PROCESSES": 1,  # Ya estamos en un proceso aparte
+        "CLUSTER_CUTOFF": CLUSTER_CUTOFF,
+        "EXTRACTION_CACHE_DB": EXTRACTION_CACHE_DB,
+        "TRACE_JSON": TRACE_JSON,
+    }
+
+def in_background(produce, maxsize):
+    """Ejecuta produce(put) en un hilo y va devolviendo lo que entrega.
+    
+    La cola está acotada: si el consumidor se retrasa, `put` bloquea al
+    productor (el motor async lo llama desde un hilo del executor, así que
+    las pestañas en curso siguen avanzando).
+    """
+    items = queue.Queue(maxsize)
+    done, errors = object(), []
+    
+    def run():
+        try:
+            produce(items.put)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            items.put(done)
+    
+    thread = threading.Thread(target=run, name="crawl", daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        yield item
+    thread.join()
+    if errors:
+        raise errors[0]
+
+def extract_pipelined(scraped, store, agencies, incremental=False, workers=None, save=True):
+    """Extrae agentes según llegan las agencias scrapeadas y las añade a `agencies`.
+    
+    Con workers > 0 la extracción corre en un pool de procesos (con como
+    mucho 2 agencias por proceso en vuelo); con 0, en este mismo hilo. El
+    orden de salida es el de llegada. Devuelve cuántas reseñas eran nuevas.
+    Sin `save` (reproceso: ya están en `store`) no se guarda nada más que
+    los agentes.
+    """
+    workers = NLP_WORKERS if workers is None else workers
+    cache = get_extraction_cache()
+    new_reviews = 0
+    
+    def saved(a):
+        # set_agents va con las claves del almacén: una reseña ya guardada conserva la suya
+        nonlocal new_reviews
+        added, keys = store.save(a)
+        new_reviews += added
+        return dict(a, review_keys=[keys[key] for key in a["review_keys"]])
+    
+    def write(job, result, remote):
+        agents, agency_data, (hits, misses) = result[:3]
+        store.set_agents(job["agency_url"], zip(job["review_keys"], agents))
+        if agency_data:
+            agencies.append(agency_data)
+        if remote:
+            METRICS.merge(result[3])
+            if cache:
+                cache.hits += hits
+                cache.misses += misses
+    
+    if not workers:
+        for a in scraped:
+            if save:
+                a = saved(a)
+            job, agents = agency_job(a, store, incremental)
+            write(job, extract_agency(job, agents), remote=False)
+        return new_reviews
+    
+    in_flight = deque()
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_nlp_worker, initargs=(nlp_worker_config(),)) as executor:
+        for a in scraped:
+            if save:
+                a = saved(a)
+            job, agents = agency_job(a, store, incremental)
+            in_flight.append((job, executor.submit(extract_agency_remote, job, agents)))
+            while len(in_flight) > 2 * workers:
+                job, future = in_flight.popleft()
+                write(job, future.result(), remote=True)
+        while in_flight:
+            job, future = in_flight.popleft()
+            write(job, future.result(), remote=True)
+    return new_reviews
+
+def write_outputs(agencies, link_agencies=False):
+    """Genera JSON, HTML, Excel y el índice de consultas leyendo `agencies` (JSONL) en streaming."""
+    canonical, global_ranking = global_agent_names(agencies) if link_agencies else (None, None)
+    records = lambda: annotate_global_agents(agencies, canonical) if canonical else iter(agencies)
+    
+    write_json(records(), OUTPUT_JSON)
+    print(f"\n✅ JSON: {OUTPUT_JSON}")
+    
+    write_html(records(), OUTPUT_HTML)
+    print(f"✅ HTML: {OUTPUT_HTML}")
+    
+    generate_excel(records(), OUTPUT_EXCEL)
+    
+    if PARQUET_EXPORT:
+        generate_parquet(records(), OUTPUT_PARQUET)
+    
+    if QUERY_DB:
+        from query_service import build_index
+        build_index(records(), QUERY_DB)
+    
+    return global_ranking
+
+def load_agency_urls(path):
+    """URLs de agencias de un fichero, sin duplicados y en orden.
+    
+    .csv: columna "url" o "agency_url" (o la primera); .jsonl: campo
+    agency_url o url; cualquier otro: una URL por línea (# comenta).
+    """
+    with open(path, encoding="utf-8", newline="") as f:
+        suffix = Path(path).suffix.lower()
+        if suffix == ".jsonl":
+            records = [json.loads(line) for line in f if line.strip()]
+            urls = [r.get("agency_url") or r.get("url") for r in records]
+        elif suffix == ".csv":
+            rows = [row for row in csv.reader(f) if row]
+            header = [h.strip().lower() for h in rows[0]] if rows else []
+            col = next((i for i, h in enumerate(header) if h in ("url", "agency_url")), 0)
+            if header and header[0].startswith("http"):
+                urls = [row[0] for row in rows]
+            else:
+                urls = [row[col] for row in rows[1:] if len(row) > col]
+        else:
+            urls = [line for line in f if not line.lstrip().startswith("#")]
+    return list(dict.fromkeys(u.strip() for u in urls if u and u.strip()))
+
+def parse_shard(value):
+    """ "i/N" (i de 1 a N) -> (i, N)."""
+    try:
+        index, total = map(int, value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard inválido: {value!r} (formato i/N)")
+    if not 1 <= index <= total:
+        raise argparse.ArgumentTypeError(f"shard inválido: {value!r} (i debe ir de 1 a N)")
+    return index, total
+
+def shard_urls(urls, index, total):
+    """Las URLs del shard `index` de `total`: siempre las mismas para una URL."""
+    return [url for url in urls
+            if int(hashlib.sha1(url.encode("utf-8")).hexdigest(), 16) % total == index - 1]
+
+def tagged(filename, tag):
+    """agentes.jsonl + "2de8" -> agentes-2de8.jsonl"""
+    path = Path(filename)
+    return str(path.with_name(f"{path.stem}-{tag}{path.suffix}"))
+
+def leased_urls(work_queue, worker_id, skip=(), known=None):
+    """URLs alquiladas de la cola, LEASE_BATCH cada vez, según las va pidiendo el pool.
+    
+    Las de `skip` (ya en el checkpoint) se dan por hechas sin scrapearlas.
+    Con `known` (modo incremental) se le añaden las claves guardadas de
+    cada lote antes de entregarlo.
+    """
+    while True:
+        leased = work_queue.lease(worker_id, LEASE_BATCH)
+        if not leased:
+            return
+        for url in leased:
+            if url in skip:
+                work_queue.done(url, worker_id)
+        batch = [url for url in leased if url not in skip]
+        if known is not None:
+            known.update(known_keys_for(batch))
+        yield from batch
+
+def known_keys_for(urls):
+    """Claves ya guardadas por URL (modo incremental), con una conexión propia."""
+    store = ReviewStore(REVIEW_DB)
+    try:
+        return {url: store.known_keys(url) for url in urls}
+    finally:
+        store.close()
+
+def merge_shards(paths, link_agencies=False):
+    """Junta las salidas JSONL de varios shards/workers en los informes finales."""
+    agencies = JsonlShards(paths)
+    print(f"🧩 Uniendo {len(paths)} ficheros: {sum(1 for _ in agencies)} agencias")
+    write_outputs(agencies, link_agencies)
+
+def run_all(engine=ENGINE, incremental=INCREMENTAL, link_agencies=LINK_ACROSS_AGENCIES, resume=False,
+            work_queue=None, worker_id=None):
+    """Scrapea AGENCY_URLS o, con `work_queue`, lo que se vaya alquilando de la cola."""
     print("\n" + "="*70)
     print("🚀 PROCESANDO AGENCIAS INMOBILIARIAS")
     print("="*70)
-    print(f"📝 Total de URLs: {len(AGENCY_URLS)}")
+    if work_queue:
+        print(f"📬 Worker {worker_id} de la cola {work_queue.path}: {work_queue.counts()}")
+    else:
+        print(f"📝 Total de URLs: {len(AGENCY_URLS)}")
     
     start_time = time.time()
     
-    # Procesar en paralelo
-    all_agencies = []
+    METRICS.trace = TRACE_JSON is not None
+    if PROMETHEUS_PORT:
+        serve_prometheus(PROMETHEUS_PORT)
+        print(f"📡 Métricas en http://127.0.0.1:{PROMETHEUS_PORT}/metrics")
     
-    if MAX_WORKERS > 1:
-        print(f"⚡ Procesamiento paralelo ({MAX_WORKERS} workers)")
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = {
-                executor.submit(scrape_single_agency, url, MAX_REVIEWS_PER_AGENCY, MAX_MONTHS_OLD): url 
-                for url in AGENCY_URLS
-            }
-            
-            for future in tqdm(as_completed(futures), total=len(AGENCY_URLS), desc="Agencias"):
-                result = future.result()
-                if result and result["reviews"]:
-                    all_agencies.append(result)
+    # Cada agencia scrapeada se añade al checkpoint en cuanto termina
+    checkpoint = JsonlCheckpoint(CHECKPOINT_JSONL)
+    if resume:
+        done = checkpoint.done()
+        print(f"⏯️  Reanudando: {len(done)} agencias ya scrapeadas en {CHECKPOINT_JSONL}")
     else:
-        print("⏳ Procesamiento secuencial")
-        for url in tqdm(AGENCY_URLS, desc="Agencias"):
-            result = scrape_single_agency(url, MAX_REVIEWS_PER_AGENCY, MAX_MONTHS_OLD)
-            if result and result["reviews"]:
-                all_agencies.append(result)
-    
-    # Procesar agentes
-    print("\n📊 EXTRAYENDO AGENTES...")
-    
-    aggregated = []
-    for a in tqdm(all_agencies, desc="Procesando"):
-        processed_reviews, agent_mentions = process_reviews_for_agents(a["reviews"])
-        
-        all_agent_names = []
-        for review in processed_reviews:
-            all_agent_names.extend(review["agents_mentioned"])
-        
-        counts = Counter(all_agent_names)
-        grouped = group_similar(counts)
-        
-        agency_data = {
-            "agency_name": a["agency_name"],
-            "agency_url": a["agency_url"],
-            "total_reviews": len(a["reviews"]),
-            "reviews_with_agents": len(processed_reviews),
-            "agentes_inmobiliarios": [
-                {
-                    "nombre_agente": agent["canonical"],
-                    "total_menciones": agent["count"],
-                    "variantes_nombre": agent["variants"],
-                    "testimonios_clientes": [
-                        {"testimonio": t} 
-                        for t in agent_mentions.get(agent["canonical"], [])[:5]
-                    ]
-                }
-                for agent in grouped
-            ]
-        }
-        aggregated.append(agency_data)
+        checkpoint.reset()
+        done = set()
+    urls = [url for url in AGENCY_URLS if url not in done] if not work_queue else []
     
-    # Guardar
-    Path(OUTPUT_JSON).write_text(json.dumps(aggregated, ensure_ascii=False, indent=2), encoding='utf-8')
-    print(f"\n✅ JSON: {OUTPUT_JSON}")
+    known = None
+    if incremental and work_queue:
+        known = {}  # leased_urls lo va llenando por lotes
+    elif incremental:
+        known = known_keys_for(urls)
+        print(f"♻️  Modo incremental: {sum(map(len, known.values()))} reseñas ya guardadas")
+    store = ReviewStore(REVIEW_DB)
     
-    Path(OUTPUT_HTML).write_text(generate_html(aggregated), encoding='utf-8')
-    print(f"✅ HTML: {OUTPUT_HTML}")
+    # Scraping en un hilo aparte; la extracción de agentes (procesos) va
+    # consumiendo cada agencia en cuanto termina
+    print(f"📊 Extrayendo agentes en paralelo al scraping ({NLP_WORKERS} procesos)")
+    scrape_time = []
+    throttled, lost = [], []
+    
+    def produce(put):
+        for a in checkpoint:  # Las ya scrapeadas (--resume) entran primero
+            put(a)
+        
+        def failed(url):
+            # Los reintentos del pool ya se agotaron: la cola no la vuelve a repartir
+            # (fuera del checkpoint, --resume sí la repite)
+            lost.append(url)
+            if work_queue:
+                work_queue.fail(url, worker_id)
+        
+        def sink(result):
+            if throttle_reason(result):
+                throttled.append(result)
+                failed(result["agency_url"])
+                return
+            checkpoint.append(result)
+            put(result)
+            if work_queue:
+                work_queue.done(result["agency_url"], worker_id)
+        
+        def crawl(urls):
+            if engine == "async":
+                asyncio.run(crawl_async(urls, sink, known, failed))
+            else:
+                crawl_threads(urls, sink, known, failed)
+        
+        scrape_start = time.time()
+        if work_queue:
+            # Un solo pool (y limitador) para todo el worker, que va alquilando
+            # lotes según los pide; lo que quede sin terminar (p. ej. al
+            # interrumpirlo) vuelve a la cola
+            with work_queue.renewing(worker_id):
+                try:
+                    crawl(leased_urls(work_queue, worker_id, skip=done, known=known))
+                finally:
+                    work_queue.release(worker_id)
+        elif urls:
+            crawl(urls)
+        scrape_time.append(time.time() - scrape_start)
+    
+    agencies = JsonlCheckpoint(AGENCIES_JSONL)
+    agencies.reset()
+    new_reviews = extract_pipelined(in_background(produce, PIPELINE_QUEUE), store, agencies, incremental)
+    store.close()
+    print(f"⏱️  Scraping ({engine}): {scrape_time[0]:.1f} s | con extracción: {time.time() - start_time:.1f} s")
+    print_timing(itertools.chain(checkpoint, throttled))
+    if lost:
+        print(f"⚠️  {len(lost)} agencias sin resultado o frenadas por Maps tras {MAX_RETRIES} reintentos "
+              f"({len(throttled)} frenadas), sin guardar")
+    print(f"💾 {new_reviews} reseñas nuevas en {REVIEW_DB}")
+    if get_extraction_cache():
+        print(get_extraction_cache().summary())
     
-    generate_excel(aggregated, OUTPUT_EXCEL)
+    # Guardar
+    with stage("write_outputs"):
+        global_ranking = write_outputs(agencies, link_agencies)
     
-    elapsed = time.time() - start_time
-    total_agents = sum(len(a['agentes_inmobiliarios']) for a in aggregated)
+    print_summary(agencies, global_ranking, time.time() - start_time)
+    if work_queue:
+        print(f"\n📬 Cola: {work_queue.counts()}")
+    print(METRICS.summary())
+    if TRACE_JSON:
+        METRICS.write_trace(TRACE_JSON)
+        print(f"🧭 Traza: {TRACE_JSON}")
+
+def print_summary(agencies, global_ranking, elapsed):
+    """Totales y top 10 de agentes del informe final."""
+    total_agencies = 0
+    total_agents = 0
+    all_agents = []
+    for agency in agencies:
+        total_agencies += 1
+        total_agents += len(agency['agentes_inmobiliarios'])
+        all_agents = heapq.nlargest(10, all_agents + [
+            (agent['nombre_agente'], agent['total_menciones'], agency['agency_name'])
+            for agent in agency['agentes_inmobiliarios']
+        ], key=lambda x: x[1])
     
     print("\n" + "="*70)
     print("✅ COMPLETADO")
     print("="*70)
     print(f"⏱️  Tiempo: {elapsed/60:.1f} minutos")
-    print(f"🏢 Agencias: {len(aggregated)}")
+    print(f"🏢 Agencias: {total_agencies}")
     print(f"👥 Agentes: {total_agents}")
     
     # Top 10
     print("\n🏆 TOP 10 AGENTES:")
-    all_agents = []
-    for agency in aggregated:
-        for agent in agency['agentes_inmobiliarios']:
-            all_agents.append((agent['nombre_agente'], agent['total_menciones'], agency['agency_name']))
-    
-    all_agents.sort(key=lambda x: x[1], reverse=True)
     for i, (name, count, agency) in enumerate(all_agents[:10], 1):
         print(f"{i:2}. {name:20} ({count:2} menciones) - {agency}")
+    
+    if global_ranking:
+        print("\n🌍 TOP 10 AGENTES (todas las oficinas):")
+        for i, (name, count, names) in enumerate(global_ranking[:10], 1):
+            print(f"{i:2}. {name:20} ({count:2} menciones) - {', '.join(names)}")
+
+def reprocess(link_agencies=False, incremental=False, urls=None):
+    """Rehace agentes e informes con las reseñas guardadas en REVIEW_DB, sin navegador.
+    
+    Usa las que aún entrarían en un crawl (ver recent_reviews) y no toca
+    la fecha del último crawl de cada agencia. Con `incremental` reutiliza
+    los agentes ya extraídos; si no, los vuelve a extraer todos (de la
+    caché si el modelo y las reglas no han cambiado). `urls` limita el
+    reproceso a esas agencias.
+    """
+    start_time = time.time()
+    store = ReviewStore(REVIEW_DB)
+    saved = [(url, name) for url, name in store.agencies() if urls is None or url in urls]
+    print(f"🔁 Reprocesando {len(saved)} agencias de {REVIEW_DB}")
+    
+    def scraped():
+        for url, name in saved:
+            rows = recent_reviews(store.agency_reviews(url), MAX_REVIEWS_PER_AGENCY, MAX_MONTHS_OLD)
+            yield {"agency_name": name, "agency_url": url,
+                   "reviews": [text for _, text, _, _ in rows], "review_keys": [key for key, _, _, _ in rows]}
+    
+    agencies = JsonlCheckpoint(AGENCIES_JSONL)
+    agencies.reset()
+    extract_pipelined(scraped(), store, agencies, incremental, save=False)
+    store.close()
+    if get_extraction_cache():
+        print(get_extraction_cache().summary())
+    
+    with stage("write_outputs"):
+        global_ranking = write_outputs(agencies, link_agencies)
+    print_summary(agencies, global_ranking, time.time() - start_time)
+    print(METRICS.summary())
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Extrae agentes inmobiliarios de las reseñas de Google Maps.")
+    parser.add_argument("--agencies", metavar="FICHERO", default=AGENCIES_FILE,
+                        help="Leer las URLs de un CSV, JSONL o texto en vez de AGENCY_URLS")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="Scrapear solo la parte i de N (reparto fijo por URL, sin cola)")
+    parser.add_argument("--queue", metavar="DB",
+                        help="Cola SQLite compartida: alquilar agencias de ella como worker")
+    parser.add_argument("--enqueue", action="store_true",
+                        help="Coordinador: añadir las agencias a la cola de --queue y salir")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="Nombre de este worker en la cola, único por proceso; repítelo con --resume "
+                             "(por defecto: %(default)s)")
+    parser.add_argument("--merge", nargs="+", metavar="JSONL",
+                        help=f"Unir las salidas de varios shards/workers en {OUTPUT_JSON} y salir")
+    parser.add_argument("--reprocess", action="store_true",
+                        help=f"Rehacer agentes e informes con las reseñas de {REVIEW_DB}, sin scrapear")
+    parser.add_argument("--engine", choices=["threads", "async"], default=ENGINE,
+                        help="Motor de scraping (por defecto: %(default)s)")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="Navegadores simultáneos como máximo (por defecto: %(default)s)")
+    parser.add_argument("--rate", type=float, default=AGENCIES_PER_MINUTE, metavar="N",
+                        help="Agencias empezadas por minuto como mucho; 0 = sin límite (por defecto: %(default)s)")
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES,
+                        help="Reintentos de una agencia frenada por Maps (por defecto: %(default)s)")
+    parser.add_argument("--pages-per-browser", type=int, default=PAGES_PER_BROWSER,
+                        help="Pestañas simultáneas por navegador en el motor async (por defecto: %(default)s)")
+    parser.add_argument("--no-block", action="store_true",
+                        help="No abortar imágenes, fuentes, teselas ni rastreadores")
+    parser.add_argument("--reviews-from", choices=["dom", "network"], default=REVIEW_SOURCE,
+                        help="Origen de las reseñas; network cae al DOM si no ve respuestas (por defecto: %(default)s)")
+    parser.add_argument("--ner-batch-size", type=int, default=NER_BATCH_SIZE,
+                        help="Reseñas por lote de spaCy (por defecto: %(default)s)")
+    parser.add_argument("--ner-processes", type=int, default=NER_PROCESSES,
+                        help="Procesos para spaCy (por defecto: %(default)s)")
+    parser.add_argument("--incremental", action="store_true", default=INCREMENTAL,
+                        help=f"Solo reseñas nuevas respecto a {REVIEW_DB}")
+    parser.add_argument("--nlp-workers", type=int, default=NLP_WORKERS,
+                        help="Procesos de extracción de agentes; 0 = sin pool (por defecto: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="No usar la caché de extracción de agentes")
+    parser.add_argument("--cluster-cutoff", type=int, default=CLUSTER_CUTOFF,
+                        help="Similitud mínima para agrupar variantes de un nombre (por defecto: %(default)s)")
+    parser.add_argument("--link-agencies", action="store_true", default=LINK_ACROSS_AGENCIES,
+                        help="Enlazar el mismo agente entre agencias distintas")
+    parser.add_argument("--parquet", action="store_true", default=PARQUET_EXPORT,
+                        help="Exportar también agencias, agentes y testimonios a Parquet (requiere pyarrow)")
+    parser.add_argument("--trace", metavar="FICHERO", default=TRACE_JSON,
+                        help="Guardar una traza JSON con los tiempos de cada etapa (Chrome/Perfetto)")
+    parser.add_argument("--prometheus-port", type=int, default=PROMETHEUS_PORT,
+                        help="Exponer métricas en formato Prometheus en este puerto")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"Continuar una ejecución interrumpida saltando las agencias de {CHECKPOINT_JSONL}")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    run_all()
\ No newline at end of file
+    args = parse_args()
+    MAX_WORKERS = args.workers
+    AGENCIES_PER_MINUTE = args.rate or None
+    MAX_RETRIES = args.max_retries
+    PAGES_PER_BROWSER = args.pages_per_browser
+    REVIEW_SOURCE = args.reviews_from
+    BLOCK_RESOURCES = not args.no_block
+    NER_BATCH_SIZE = args.ner_batch_size
+    NER_PROCESSES = args.ner_processes
+    NLP_WORKERS = args.nlp_workers
+    TRACE_JSON = args.trace
+    PARQUET_EXPORT = args.parquet
+    PROMETHEUS_PORT = args.prometheus_port
+    if args.no_cache:
+        EXTRACTION_CACHE_DB = None
+    CLUSTER_CUTOFF = args.cluster_cutoff
+    
+    if args.merge:
+        merge_shards(args.merge, link_agencies=args.link_agencies)
+        raise SystemExit
+    
+    if args.agencies:
+        AGENCY_URLS = load_agency_urls(args.agencies)
+    
+    if args.reprocess:
+        reprocess(link_agencies=args.link_agencies, incremental=args.incremental,
+                  urls=set(AGENCY_URLS) if args.agencies else None)
+        raise SystemExit
+    
+    work_queue = None
+    if args.queue:
+        work_queue = LeaseQueue(args.queue, ttl=LEASE_TTL)
+        if args.enqueue:
+            added = work_queue.add(AGENCY_URLS)
+            print(f"📬 {added} agencias nuevas en {args.queue}: {work_queue.counts()}")
+            raise SystemExit
+    
+    # Cada shard/worker escribe sus propios ficheros; luego se unen con --merge
+    tag = None
+    if args.shard:
+        AGENCY_URLS = shard_urls(AGENCY_URLS, *args.shard)
+        tag = "{}de{}".format(*args.shard)
+    elif work_queue:
+        tag = re.sub(r"[^\w.-]", "_", args.worker_id)
+    if tag:
+        CHECKPOINT_JSONL, AGENCIES_JSONL = tagged(CHECKPOINT_JSONL, tag), tagged(AGENCIES_JSONL, tag)
+        OUTPUT_JSON, OUTPUT_HTML, OUTPUT_EXCEL, OUTPUT_PARQUET = (
+            tagged(OUTPUT_JSON, tag), tagged(OUTPUT_HTML, tag), tagged(OUTPUT_EXCEL, tag), tagged(OUTPUT_PARQUET, tag))
+        QUERY_DB = QUERY_DB and tagged(QUERY_DB, tag)
+    
+    run_all(engine=args.engine, incremental=args.incremental, link_agencies=args.link_agencies,
+            resume=args.resume, work_queue=work_queue, worker_id=args.worker_id)
\ No newline at end of file
@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Pool de navegadores Chromium de larga duración para el scraper de agencias."""
+
+import asyncio, heapq, itertools, json, os, queue, random, re, threading, time
+
+from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
+
+from metrics import incr
+
+# Lo que el scraper nunca lee: se aborta antes de descargarlo
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font"}
+BLOCKED_URL_RE = re.compile(
+    r"/maps/vt[/?]|/kh/v|khms\d*\.google|streetviewpixels|/maps/preview/log204|/gen_204"
+    r"|googletagmanager\.com|google-analytics\.com|doubleclick\.net|play\.google\.com/log"
+)
+# Cookies con las que Google da el consentimiento por aceptado
+CONSENT_COOKIES = {"SOCS", "CONSENT"}
+
+
+_DONE = object()  # Fin de los items de imap()
+_WAIT = object()  # Aún no: quedan reintentos por vencer o items en curso
+_PULL = object()  # Leer el siguiente del iterable
+ASYNC_POLL_S = 0.5  # Cada cuánto mira una tarea asyncio ociosa si ya hay algo que hacer
+
+
+class Retry:
+    """Lo que devuelve `fn` en imap() para repetir el item más tarde, en un contexto nuevo."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+
+class _Failed:
+    """Error del iterable de imap() en un hilo o tarea; imap() lo relanza al terminar."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _Feed:
+    """Los items de imap(), repartidos entre hilos o tareas.
+
+    El iterable se lee bajo su propio lock (puede tardar: p. ej. alquilar de
+    una cola). Un item devuelto con finish(item, delay) vuelve a salir cuando
+    pasa su espera; mientras, se sigue con los demás. Se acaba cuando el
+    iterable se agota y no queda nada en curso ni por reintentar.
+    """
+
+    def __init__(self, items):
+        self._items = iter(items)
+        self._items_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._exhausted = False
+        self._retries = []  # heap de (no antes de, n, item)
+        self._seq = itertools.count()
+        self._in_flight = 0
+
+    def _take(self):
+        now = time.monotonic()
+        if self._retries and self._retries[0][0] <= now:
+            self._in_flight += 1
+            return heapq.heappop(self._retries)[2], None
+        if not self._exhausted:
+            self._in_flight += 1  # Reservado mientras se lee del iterable
+            return _PULL, None
+        if self._retries or self._in_flight:
+            return _WAIT, (self._retries[0][0] - now if self._retries else None)
+        return _DONE, None
+
+    def _pull(self):
+        try:
+            with self._items_lock:
+                item = next(self._items, _DONE)
+        except BaseException:
+            # Sin esto, el hueco reservado en _take no se libera y los demás esperan para siempre
+            with self._cond:
+                self._exhausted = True
+                self._in_flight -= 1
+                self._cond.notify_all()
+            raise
+        if item is _DONE:
+            with self._cond:
+                self._exhausted = True
+                self._in_flight -= 1
+                self._cond.notify_all()
+        return item
+
+    def next(self):
+        """El siguiente item (esperando a los reintentos si hace falta), o _DONE."""
+        while True:
+            with self._cond:
+                item, wait = self._take()
+                while item is _WAIT:
+                    self._cond.wait(wait)
+                    item, wait = self._take()
+            if item is not _PULL:
+                return item
+            item = self._pull()
+            if item is not _DONE:
+                return item
+
+    def poll(self):
+        """Como next() sin esperar: (item, None), (_DONE, None) o (_WAIT, segundos o None)."""
+        while True:
+            with self._cond:
+                item, wait = self._take()
+            if item is not _PULL:
+                return item, wait
+            item = self._pull()
+            if item is not _DONE:
+                return item, None
+
+    def finish(self, item, delay=None):
+        """Item terminado; con `delay`, vuelve a salir dentro de `delay` segundos."""
+        with self._cond:
+            self._in_flight -= 1
+            if delay is not None:
+                heapq.heappush(self._retries, (time.monotonic() + delay, next(self._seq), item))
+            self._cond.notify_all()
+
+
+def blocked(request):
+    return request.resource_type in BLOCKED_RESOURCE_TYPES or BLOCKED_URL_RE.search(request.url) is not None
+
+
+def route_blocked(route):
+    """Handler de `context.route("**/*", ...)` que aborta lo bloqueado."""
+    if blocked(route.request):
+        incr("blocked_requests")
+        route.abort()
+    else:
+        route.continue_()
+
+
+async def route_blocked_async(route):
+    if blocked(route.request):
+        incr("blocked_requests")
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+def load_consent(path):
+    """storage_state guardado por save_consent, o None si aún no hay."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def save_consent(state, path):
+    """Deja en `state` solo las cookies de consentimiento; las guarda en `path` si hay.
+
+    Devuelve el storage_state reducido, o None si la página aún no había aceptado.
+    """
+    cookies = [c for c in state.get("cookies", []) if c["name"] in CONSENT_COOKIES]
+    if not cookies:
+        return None
+    consent = {"cookies": cookies, "origins": []}
+    if path:
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(consent, f)
+        os.replace(tmp, path)
+    return consent
+
+
+class BrowserPool:
+    """Reparte agencias entre un número fijo de navegadores reutilizables.
+
+    La API síncrona de Playwright ata cada navegador al hilo que lo lanzó, así
+    que cada navegador vive en su propio hilo y atiende una agencia cada vez.
+    Cada agencia recibe un contexto nuevo que se cierra al devolverla; el
+    navegador se recicla tras `recycle_after` páginas o si se cae.
+
+    Los contextos solo comparten las cookies de consentimiento: las de la
+    primera página que lo aceptó, guardadas en `consent_state` (JSON de
+    storage_state) para este y los siguientes crawls. Con `block_resources`
+    se abortan imágenes, vídeo, fuentes, teselas del mapa y rastreadores.
+    """
+
+    def __init__(self, browsers=3, recycle_after=25, headless=True, user_agents=None,
+                 block_resources=True, consent_state=None):
+        self.browsers = max(1, browsers)
+        self.recycle_after = max(1, recycle_after)
+        self.headless = headless
+        self.user_agents = user_agents or [None]
+        self.block_resources = block_resources
+        self.consent_state = consent_state
+        self.consent = load_consent(consent_state)
+
+        self.launches = 0
+        self.pages = 0  # Intentos: cada llamada a fn, reintentos incluidos
+        self.agencies = 0  # Items terminados (sin contar los Retry)
+        self.recycles = 0
+        self.crashes = 0
+        self._lock = threading.Lock()
+
+    def _count(self, field, n=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def _new_context(self, browser):
+        ctx = browser.new_context(user_agent=random.choice(self.user_agents), storage_state=self.consent)
+        if self.block_resources:
+            ctx.route("**/*", route_blocked)
+        return ctx
+
+    def _remember_consent(self, ctx):
+        if self.consent is not None:
+            return
+        state = ctx.storage_state()
+        with self._lock:
+            if self.consent is None:
+                self.consent = save_consent(state, self.consent_state)
+
+    def _worker(self, fn, feed, results):
+        try:
+            # Playwright solo arranca si a este hilo le llega algún item
+            item = feed.next()
+            if item is not _DONE:
+                self._start(fn, item, feed, results)
+        except Exception as e:
+            results.put(_Failed(e))
+        finally:
+            results.put(_DONE)
+
+    def _start(self, fn, item, feed, results):
+        try:
+            pw = sync_playwright().start()
+        except Exception as e:
+            # Playwright no arrancó: contestar None a lo que quede para que imap() no se quede esperando
+            print(f"✗ Error arrancando Playwright: {e}")
+            while item is not _DONE:
+                feed.finish(item)
+                results.put(None)
+                item = feed.next()
+            return
+        try:
+            self._serve(pw, fn, item, feed, results)
+        finally:
+            pw.stop()
+
+    def _serve(self, pw, fn, item, feed, results):
+        browser, served = None, 0
+        while item is not _DONE:
+            result = None
+            try:
+                if browser is not None and served >= self.recycle_after:
+                    self._count("recycles")
+                    _close_quietly(browser)
+                    browser = None
+                if browser is None:
+                    browser = pw.chromium.launch(headless=self.headless)
+                    served = 0
+                    self._count("launches")
+
+                ctx = self._new_context(browser)
+                try:
+                    result = fn(ctx.new_page(), item)
+                    self._remember_consent(ctx)
+                finally:
+                    try: ctx.close()
+                    except: pass
+            except Exception as e:
+                print(f"✗ Error en {item}: {e}")
+            finally:
+                served += 1
+                self._count("pages")
+                if browser is not None and not browser.is_connected():
+                    self._count("crashes")
+                    browser = None
+                if isinstance(result, Retry):
+                    feed.finish(item, result.delay)
+                else:
+                    self._count("agencies")
+                    feed.finish(item)
+                    results.put(result)
+            item = feed.next()
+
+        if browser is not None:
+            _close_quietly(browser)
+
+    def imap(self, fn, items):
+        """Ejecuta `fn(tab, item)` para cada item y devuelve resultados según terminan.
+
+        `items` se consume a medida que quedan navegadores libres, así que
+        puede ser un generador largo (p. ej. agencias alquiladas de una cola)
+        sin relanzar los navegadores entre lotes. Si `fn` devuelve un Retry,
+        el item vuelve a la cola con su espera y lo recoge el primer
+        navegador libre (relanzado si se cayó), sin ocuparlo mientras tanto.
+        Si leer `items` lanza una excepción, se terminan los items en curso y
+        se relanza aquí.
+        """
+        feed, results = _Feed(items), queue.Queue()
+        threads = [
+            threading.Thread(target=self._worker, args=(fn, feed, results), daemon=True)
+            for _ in range(self.browsers)
+        ]
+        for t in threads:
+            t.start()
+
+        running, failed = len(threads), None
+        while running:
+            result = results.get()
+            if result is _DONE:
+                running -= 1
+            elif isinstance(result, _Failed):
+                failed = failed or result
+            else:
+                yield result
+
+        for t in threads:
+            t.join()
+        if failed:
+            raise failed.error
+
+    @property
+    def saved_launches(self):
+        # Antes se lanzaba un Chromium por agencia
+        return max(0, self.agencies - self.launches)
+
+    def summary(self):
+        return (f"🌐 Navegadores: {self.launches} lanzamientos para {self.agencies} agencias "
+                f"({self.pages} intentos, {self.saved_launches} ahorrados) | ♻️ {self.recycles} reciclados | "
+                f"💥 {self.crashes} caídos")
+
+
+class _AsyncSlot:
+    def __init__(self):
+        self.browser = None
+        self.active = 0
+        self.served = 0
+
+
+class AsyncBrowserPool:
+    """Versión asyncio del pool: un solo hilo maneja todas las pestañas.
+
+    Cada navegador atiende hasta `pages_per_browser` agencias a la vez, y
+    `browsers * pages_per_browser` tareas se reparten los items, una
+    pestaña cada una.
+    Consentimiento y bloqueo de recursos, como en BrowserPool.
+    """
+
+    def __init__(self, browsers=3, pages_per_browser=4, recycle_after=25, headless=True, user_agents=None,
+                 block_resources=True, consent_state=None):
+        self.browsers = max(1, browsers)
+        self.pages_per_browser = max(1, pages_per_browser)
+        self.recycle_after = max(1, recycle_after)
+        self.headless = headless
+        self.user_agents = user_agents or [None]
+        self.block_resources = block_resources
+        self.consent_state = consent_state
+        self.consent = load_consent(consent_state)
+
+        self.launches = 0
+        self.pages = 0  # Intentos: cada llamada a fn, reintentos incluidos
+        self.agencies = 0  # Items terminados (sin contar los Retry)
+        self.recycles = 0
+        self.crashes = 0
+
+    @property
+    def concurrency(self):
+        return self.browsers * self.pages_per_browser
+
+    async def _acquire(self, pw):
+        async with self._cond:
+            while True:
+                slot = next((s for s in self._slots
+                             if s.active < self.pages_per_browser and s.served < self.recycle_after), None)
+                if slot is not None:
+                    break
+                await self._cond.wait()
+
+            slot.active += 1
+            slot.served += 1
+            if slot.browser is None:
+                try:
+                    slot.browser = await pw.chromium.launch(headless=self.headless)
+                except Exception:
+                    slot.active -= 1
+                    slot.served -= 1
+                    self._cond.notify_all()
+                    raise
+                self.launches += 1
+            return slot
+
+    async def _release(self, slot):
+        async with self._cond:
+            slot.active -= 1
+            self.pages += 1
+
+            crashed = slot.browser is not None and not slot.browser.is_connected()
+            if crashed:
+                # Las pestañas que aún usan este navegador fallarán y lo devolverán
+                self.crashes += 1
+                slot.browser = None
+                slot.served = 0
+            elif slot.active == 0 and slot.served >= self.recycle_after:
+                self.recycles += 1
+                await _close_quietly_async(slot.browser)
+                slot.browser = None
+                slot.served = 0
+
+            self._cond.notify_all()
+
+    async def _new_context(self, browser):
+        ctx = await browser.new_context(user_agent=random.choice(self.user_agents), storage_state=self.consent)
+        if self.block_resources:
+            await ctx.route("**/*", route_blocked_async)
+        return ctx
+
+    async def _remember_consent(self, ctx):
+        if self.consent is None:
+            state = await ctx.storage_state()
+            if self.consent is None:
+                self.consent = save_consent(state, self.consent_state)
+
+    async def _run_one(self, pw, fn, item):
+        result = None
+        try:
+            slot = await self._acquire(pw)
+        except Exception as e:
+            print(f"✗ Error en {item}: {e}")
+            return None
+
+        try:
+            ctx = await self._new_context(slot.browser)
+            try:
+                result = await fn(await ctx.new_page(), item)
+                await self._remember_consent(ctx)
+            finally:
+                try: await ctx.close()
+                except: pass
+        except Exception as e:
+            print(f"✗ Error en {item}: {e}")
+        finally:
+            await self._release(slot)
+        return result
+
+    async def _work(self, pw, fn, feed, results):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # El iterable puede bloquear (p. ej. alquilar de la cola): fuera del bucle de eventos
+                item, wait = await loop.run_in_executor(None, feed.poll)
+                if item is _DONE:
+                    break
+                if item is _WAIT:
+                    await asyncio.sleep(ASYNC_POLL_S if wait is None else min(wait, ASYNC_POLL_S))
+                    continue
+                result = await self._run_one(pw, fn, item)
+                if isinstance(result, Retry):
+                    feed.finish(item, result.delay)
+                else:
+                    self.agencies += 1
+                    feed.finish(item)
+                    results.put_nowait(result)
+        except Exception as e:
+            results.put_nowait(_Failed(e))
+        finally:
+            results.put_nowait(_DONE)
+
+    async def imap(self, fn, items):
+        """Ejecuta `await fn(tab, item)` para cada item y devuelve resultados según terminan.
+
+        Como en BrowserPool, `items` se consume a medida que quedan pestañas
+        libres, un Retry devuelve el item a la cola sin ocupar la pestaña y
+        un error al leer `items` se relanza cuando acaban los que estaban en
+        curso.
+        """
+        async with async_playwright() as pw:
+            self._slots = [_AsyncSlot() for _ in range(self.browsers)]
+            self._cond = asyncio.Condition()
+
+            feed, results = _Feed(items), asyncio.Queue()
+            tasks = [asyncio.ensure_future(self._work(pw, fn, feed, results)) for _ in range(self.concurrency)]
+            try:
+                running, failed = len(tasks), None
+                while running:
+                    result = await results.get()
+                    if result is _DONE:
+                        running -= 1
+                    elif isinstance(result, _Failed):
+                        failed = failed or result
+                    else:
+                        yield result
+                if failed:
+                    raise failed.error
+            finally:
+                for t in tasks:
+                    t.cancel()
+                for slot in self._slots:
+                    if slot.browser is not None:
+                        await _close_quietly_async(slot.browser)
+
+    @property
+    def saved_launches(self):
+        return max(0, self.agencies - self.launches)
+
+    summary = BrowserPool.summary
+
+
+def _close_quietly(browser):
+    try:
+        browser.close()
+    except: pass
+
+
+async def _close_quietly_async(browser):
+    try:
+        await browser.close()
+    except: pass
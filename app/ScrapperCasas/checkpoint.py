@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Ficheros JSONL de solo-añadir para guardar resultados según van saliendo."""
+
+import json, os, threading
+
+
+class JsonlCheckpoint:
+    """Un registro JSON por línea, escrito y volcado a disco al momento.
+
+    Si el proceso muere a mitad de una línea, esa línea se ignora al leer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def reset(self):
+        open(self.path, "w", encoding="utf-8").close()
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __iter__(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def done(self, key="agency_url"):
+        return {record[key] for record in self}
+
+
+class JsonlShards:
+    """Varios JSONL leídos como uno solo, sin repetir `key` (gana el primero)."""
+
+    def __init__(self, paths, key="agency_url"):
+        self.paths = list(paths)
+        self.key = key
+
+    def __iter__(self):
+        seen = set()
+        for path in self.paths:
+            for record in JsonlCheckpoint(path):
+                if record[self.key] not in seen:
+                    seen.add(record[self.key])
+                    yield record
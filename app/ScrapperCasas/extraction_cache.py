@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Caché en disco de la extracción de agentes, indexada por el texto de la reseña."""
+
+import hashlib, json, sqlite3, time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS extractions (
+    text_hash TEXT PRIMARY KEY,
+    agents    TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS extractions_last_used ON extractions (last_used);
+"""
+CHUNK = 500  # Claves por consulta (límite de variables de SQLite)
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+    """Resultados de extracción por hash de texto, con expulsión LRU.
+
+    `version` resume el modelo de spaCy y las reglas (diccionario, patrones);
+    si cambia, la caché se vacía al abrirla.
+    """
+
+    def __init__(self, path, version, max_entries=200_000):
+        self.path = path
+        self.version = version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # Los workers de extracción (procesos aparte) escriben a la vez en el mismo fichero
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if not row or row[0] != version:
+            with self.db:
+                self.db.execute("DELETE FROM extractions")
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,))
+
+    def close(self):
+        self.db.close()
+
+    def get_many(self, hashes):
+        """{hash: agentes} de los que estén en caché (y los marca como usados)."""
+        found = {}
+        hashes = list(dict.fromkeys(hashes))
+        for i in range(0, len(hashes), CHUNK):
+            chunk = hashes[i:i + CHUNK]
+            marks = ",".join("?" * len(chunk))
+            rows = self.db.execute(
+                f"SELECT text_hash, agents FROM extractions WHERE text_hash IN ({marks})", chunk)
+            found.update((h, json.loads(agents)) for h, agents in rows)
+
+        if found:
+            now = time.time()
+            with self.db:
+                self.db.executemany("UPDATE extractions SET last_used = ? WHERE text_hash = ?",
+                                    [(now, h) for h in found])
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Guarda [(hash, agentes)] y expulsa los menos usados si se pasa del tamaño."""
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO extractions (text_hash, agents, last_used) VALUES (?, ?, ?)",
+                [(h, json.dumps(agents, ensure_ascii=False), now) for h, agents in items],
+            )
+            (count,) = self.db.execute("SELECT COUNT(*) FROM extractions").fetchone()
+            if count > self.max_entries:
+                self.db.execute(
+                    "DELETE FROM extractions WHERE text_hash IN "
+                    "(SELECT text_hash FROM extractions ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0
+        return f"🗃️  Caché de extracción: {self.hits}/{total} aciertos ({rate:.0f}%)"
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Parseo del HTML de Maps: lxml si está instalado, si no BeautifulSoup.
+
+El texto de cada tarjeta es el mismo que daría get_text(" ", strip=True)
+de BeautifulSoup, sea cual sea el backend.
+"""
+
+from bs4 import BeautifulSoup, CData, NavigableString
+
+try:
+    from lxml import html as lxml_html
+except ImportError:  # lxml es opcional
+    lxml_html = None
+
+BACKEND = "lxml" if lxml_html is not None else "html.parser"
+MIN_CARD_TEXT = 50  # Longitud (sin espacios de los extremos) de una tarjeta en el modo sin selectores
+MAX_CARD_TEXT = 5000
+# get_text() no cuenta el contenido de estas etiquetas (ni los comentarios)
+SKIP_TAGS = {"script", "style", "template"}
+TEXT_TYPES = (NavigableString, CData)
+
+
+# -------- lxml --------
+def _lxml_tree(html):
+    if not html.strip():
+        return None
+    try:
+        return lxml_html.document_fromstring(html)
+    except ValueError:  # str con declaración de codificación
+        return lxml_html.document_fromstring(html.encode("utf-8"))
+
+def _lxml_strings(el):
+    # Como get_text(): sin comentarios ni texto de script/style/template
+    if el.tag in SKIP_TAGS:
+        return
+    if el.text:
+        yield el.text
+    for child in el:
+        if isinstance(child.tag, str):
+            yield from _lxml_strings(child)
+        if child.tail:
+            yield child.tail
+
+def _lxml_text(el, sep):
+    return sep.join(t for t in (s.strip() for s in _lxml_strings(el)) if t)
+
+def _lxml_leaf_cards(root):
+    """Divs con 50-5000 caracteres de texto que no contienen otro así.
+
+    Un solo recorrido: cada nodo de texto se mide una vez y las tarjetas
+    resultantes no se solapan.
+    """
+    leaves = []
+
+    def walk(el):
+        if el.tag in SKIP_TAGS:
+            return 0, False
+        size = len(el.text.strip()) if el.text else 0
+        nested = False
+        for child in el:
+            if isinstance(child.tag, str):
+                child_size, child_nested = walk(child)
+                size += child_size
+                nested = nested or child_nested
+            if child.tail:
+                size += len(child.tail.strip())
+        card = el.tag == "div" and MIN_CARD_TEXT < size < MAX_CARD_TEXT
+        if card and not nested:
+            leaves.append(el)
+        return size, nested or card
+
+    walk(root)
+    return leaves
+
+
+# -------- BeautifulSoup --------
+def _soup_leaf_cards(root):
+    leaves = []
+
+    def walk(tag):
+        size, nested = 0, False
+        for child in tag.children:
+            if isinstance(child, NavigableString):
+                if type(child) in TEXT_TYPES:
+                    size += len(child.strip())
+            elif child.name is not None:
+                child_size, child_nested = walk(child)
+                size += child_size
+                nested = nested or child_nested
+        card = tag.name == "div" and MIN_CARD_TEXT < size < MAX_CARD_TEXT
+        if card and not nested:
+            leaves.append(tag)
+        return size, nested or card
+
+    walk(root)
+    return leaves
+
+
+# -------- API --------
+def agency_name(html):
+    """Texto del primer h1 (o h2) de la página, o "SinNombre"."""
+    if lxml_html is not None:
+        root = _lxml_tree(html)
+        if root is not None:
+            for tag in ("h1", "h2"):
+                found = root.find(f".//{tag}")
+                if found is not None:
+                    return _lxml_text(found, "")
+        return "SinNombre"
+
+    soup = BeautifulSoup(html, "html.parser")
+    name_el = soup.select_one("h1") or soup.select_one("h2")
+    return name_el.get_text(strip=True) if name_el else "SinNombre"
+
+def review_cards(html):
+    """Texto de cada tarjeta de reseña del HTML.
+
+    Sin tarjetas reconocibles, usa los contenedores hoja con longitud de
+    reseña (ver _lxml_leaf_cards).
+    """
+    if lxml_html is not None:
+        root = _lxml_tree(html)
+        if root is None:
+            return []
+        cards = (root.xpath("//div[@data-review-id]")
+                 or root.xpath("//div[contains(@jsaction, 'review')]")
+                 or _lxml_leaf_cards(root))
+        return [_lxml_text(card, " ") for card in cards]
+
+    soup = BeautifulSoup(html, "html.parser")
+    cards = (soup.select("div[data-review-id]")
+             or soup.select("div[jsaction*='review']")
+             or _soup_leaf_cards(soup))
+    return [card.get_text(" ", strip=True) for card in cards]
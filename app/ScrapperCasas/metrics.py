@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Métricas por etapa: histogramas de tiempos, contadores y traza JSON."""
+
+import bisect, json, os, threading, time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Límites superiores (s) de los cubos de los histogramas, como en Prometheus
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Cota superior del cuantil `q` (el límite del cubo que lo contiene)."""
+        target, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """Registro compartido por hilos; `drain`/`merge` lo pasan entre procesos.
+
+    Los eventos de la traza solo se guardan si `trace` está activo.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        self.gauges = {}  # Valores instantáneos del proceso principal (no pasan por drain)
+        self.events = []
+        self.trace = False
+        self._lock = threading.Lock()
+
+    def observe(self, stage, start, seconds, agency=""):
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds)
+            if self.trace:
+                self.events.append((stage, start, seconds, agency, os.getpid(), threading.get_ident()))
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def drain(self):
+        """Devuelve lo acumulado y vacía el registro (para enviarlo a otro proceso)."""
+        with self._lock:
+            snapshot = (self.histograms, self.counters, self.events)
+            self.histograms, self.counters, self.events = {}, Counter(), []
+        return snapshot
+
+    def merge(self, snapshot):
+        histograms, counters, events = snapshot
+        with self._lock:
+            for stage, hist in histograms.items():
+                self.histograms.setdefault(stage, Histogram()).merge(hist)
+            self.counters.update(counters)
+            if self.trace:
+                self.events.extend(events)
+
+    def summary(self):
+        lines = [f"\n📈 ETAPAS ({'n':>6} {'total':>9} {'p50':>8} {'p95':>8} {'máx':>8}):"]
+        with self._lock:
+            for stage, h in sorted(self.histograms.items(), key=lambda kv: -kv[1].sum):
+                lines.append(f"   {stage:28} {h.count:6} {h.sum:8.1f}s {h.quantile(0.5):7.2f}s "
+                             f"{h.quantile(0.95):7.2f}s {h.max:7.2f}s")
+            if self.counters:
+                lines.append("   " + " | ".join(f"{k}: {v}" for k, v in sorted(self.counters.items())))
+            if self.gauges:
+                lines.append("   " + " | ".join(f"{k}: {v:g}" for k, v in sorted(self.gauges.items())))
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """Formato de texto de Prometheus."""
+        out = ["# TYPE scraper_stage_seconds histogram"]
+        with self._lock:
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(BUCKETS, h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    out.append(f'scraper_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                out.append(f'scraper_stage_seconds_sum{{stage="{stage}"}} {h.sum}')
+                out.append(f'scraper_stage_seconds_count{{stage="{stage}"}} {h.count}')
+            for name, value in sorted(self.counters.items()):
+                out.append(f"# TYPE scraper_{name}_total counter")
+                out.append(f"scraper_{name}_total {value}")
+            for name, value in sorted(self.gauges.items()):
+                out.append(f"# TYPE scraper_{name} gauge")
+                out.append(f"scraper_{name} {value}")
+        return "\n".join(out) + "\n"
+
+    def write_trace(self, path):
+        """Traza en formato Chrome/Perfetto: una fila por agencia."""
+        rows, trace = {}, []
+        with self._lock:
+            events = list(self.events)
+        for stage, start, seconds, agency, pid, tid in events:
+            key = (pid, agency or tid)
+            if key not in rows:
+                rows[key] = len(rows) + 1
+                trace.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": rows[key],
+                              "args": {"name": agency or f"hilo {tid}"}})
+            trace.append({"ph": "X", "name": stage, "pid": pid, "tid": rows[key],
+                          "ts": round(start * 1e6), "dur": round(seconds * 1e6),
+                          "args": {"agency": agency}})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+
+METRICS = Metrics()
+# Agencia en curso (por hilo del pool o por tarea asyncio)
+_agency = ContextVar("metrics_agency", default="")
+
+
+def set_agency(url):
+    _agency.set(url)
+
+
+@contextmanager
+def stage(name):
+    """Mide el bloque como la etapa `name` de la agencia en curso."""
+    start, t0 = time.time(), time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.observe(name, start, time.perf_counter() - t0, _agency.get())
+
+
+def incr(name, n=1):
+    METRICS.count(name, n)
+
+
+def set_gauge(name, value):
+    METRICS.gauge(name, value)
+
+
+def response_size(response):
+    """Cuenta los bytes de una respuesta según su Content-Length (sin leer el cuerpo)."""
+    try:
+        size = int(response.headers.get("content-length") or 0)
+    except (ValueError, AttributeError):
+        return
+    if size:
+        METRICS.count("bytes_received", size)
+
+
+def serve_prometheus(port, host="127.0.0.1"):
+    """Expone /metrics en `port` desde un hilo; devuelve el servidor."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            found = self.path.startswith("/metrics")
+            body = (METRICS.prometheus() if found else "not found\n").encode("utf-8")
+            self.send_response(200 if found else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
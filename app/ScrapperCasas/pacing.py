@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Pausas adaptativas y contabilidad de tiempo esperando vs trabajando."""
+
+import asyncio, random, threading, time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+
+
+class PacingController:
+    """Pausa de cortesía que se adapta a la velocidad de Maps.
+
+    Si las esperas por condición se resuelven rápido, la pausa se acorta; si
+    tardan o agotan el tiempo, se alarga (hasta `ceiling`). Es compartido por
+    todos los hilos/tareas, así que una ralentización frena a todo el crawl.
+    """
+
+    def __init__(self, base=1.0, floor=0.2, ceiling=5.0, fast=0.8, slow=2.5):
+        self.delay = base
+        self.floor = floor
+        self.ceiling = ceiling
+        self.fast = fast
+        self.slow = slow
+        self._lock = threading.Lock()
+
+    def observe(self, latency, timed_out=False):
+        with self._lock:
+            if timed_out or latency > self.slow:
+                self.delay = min(self.ceiling, self.delay * 1.5)
+            elif latency < self.fast:
+                self.delay = max(self.floor, self.delay * 0.85)
+
+    def next_delay(self):
+        return self.delay * random.uniform(0.75, 1.25)
+
+
+class AgencyStats:
+    """Tiempo de una agencia repartido en esperas, pausas y trabajo."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.wait = 0.0
+        self.pause = 0.0
+        self.timeouts = 0
+        self.throttle = None  # Primera señal de que Maps nos está frenando (429, captcha)
+
+    def as_dict(self):
+        total = time.perf_counter() - self.start
+        return {
+            "total_s": round(total, 2),
+            "wait_s": round(self.wait, 2),
+            "pause_s": round(self.pause, 2),
+            "work_s": round(max(0.0, total - self.wait - self.pause), 2),
+            "timeouts": self.timeouts,
+            "throttle": self.throttle,
+        }
+
+
+# Una por hilo del pool síncrono o por tarea asyncio
+_current_stats = ContextVar("agency_stats", default=None)
+
+
+def start_agency_stats():
+    stats = AgencyStats()
+    _current_stats.set(stats)
+    return stats
+
+
+def _add(field, seconds):
+    stats = _current_stats.get()
+    if stats is not None:
+        setattr(stats, field, getattr(stats, field) + seconds)
+
+
+def record_timeout():
+    _add("timeouts", 1)
+
+
+def record_throttle(reason):
+    """Marca la agencia en curso como frenada por Maps (solo cuenta la primera señal)."""
+    stats = _current_stats.get()
+    if stats is not None and stats.throttle is None:
+        stats.throttle = reason
+
+
+@contextmanager
+def waiting():
+    """Cuenta el bloque como tiempo esperando a la página."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add("wait", time.perf_counter() - t0)
+
+
+def pause(pacer):
+    delay = pacer.next_delay()
+    time.sleep(delay)
+    _add("pause", delay)
+
+
+async def pause_async(pacer):
+    delay = pacer.next_delay()
+    await asyncio.sleep(delay)
+    _add("pause", delay)
+
+
+class TokenBucket:
+    """Límite de ritmo: `rate` por segundo con ráfagas de hasta `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Coge un token si hay; si no, devuelve cuánto falta para el siguiente."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class AIMDLimit:
+    """Concurrencia adaptativa al estilo TCP: +1 por cada ventana de éxitos,
+    a la mitad ante una señal de bloqueo (como mucho una vez cada `cooldown` s).
+    """
+
+    def __init__(self, initial, minimum=1, maximum=8, decrease=0.5, cooldown=30.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(maximum, max(minimum, initial)))
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.error_rate = 0.0  # Media móvil de fallos/bloqueos
+        self.active = 0
+        self._last_decrease = 0.0
+
+    @property
+    def concurrency(self):
+        return max(self.minimum, int(self.limit))
+
+    def _record(self, ok):
+        self.error_rate = 0.8 * self.error_rate + 0.2 * (0.0 if ok else 1.0)
+        if ok:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        elif time.monotonic() - self._last_decrease >= self.cooldown:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self._last_decrease = time.monotonic()
+
+
+class AdaptiveConcurrency(AIMDLimit):
+    """AIMDLimit para hilos: `slot()` espera a que haya hueco."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            while self.active >= self.concurrency:
+                self._cond.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._cond.notify_all()
+
+    def record(self, ok):
+        with self._cond:
+            self._record(ok)
+            self._cond.notify_all()
+
+
+class AsyncAdaptiveConcurrency(AIMDLimit):
+    """AIMDLimit para asyncio (créese dentro del bucle de eventos)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.active < self.concurrency)
+            self.active += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.active -= 1
+                self._cond.notify_all()
+
+    async def record(self, ok):
+        async with self._cond:
+            self._record(ok)
+            self._cond.notify_all()
+
+
+def backoff_delay(attempt, base, cap=600.0):
+    """Espera exponencial con jitter antes del reintento número `attempt` (desde 0)."""
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
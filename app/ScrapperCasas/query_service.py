@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Índice SQLite de agentes y testimonios, con una API HTTP/JSON local.
+
+  python query_service.py build agentes_inmobiliarios.jsonl
+  python query_service.py serve --port 8765
+
+  GET /agents?q=jose&fuzzy=1&limit=20     agentes por prefijo (o parecido) del nombre
+  GET /agencies?agent=Jose Mena           agencias que mencionan a un agente
+  GET /testimonials?q=hipoteca&agent=...&agency=...&after=0&limit=20
+  GET /leaderboard?limit=10&offset=0      ranking de agentes de todas las oficinas
+  GET /stats
+
+Los testimonios se buscan con FTS5 y se paginan por cursor (`after` = el
+`next` de la página anterior), así que ninguna página recorre las previas.
+"""
+
+import argparse, json, os, sqlite3, threading, time, unicodedata
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+QUERY_DB = "consultas.db"
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 500
+FUZZY_CUTOFF = 80  # Puntuación mínima (WRatio) de la búsqueda aproximada
+POOL_SIZE = 8  # Conexiones de solo lectura que se guardan entre peticiones
+
+SCHEMA = """
+CREATE TABLE agencies (
+    id          INTEGER PRIMARY KEY,
+    agency_url  TEXT,
+    agency_name TEXT
+);
+CREATE TABLE agents (
+    id        INTEGER PRIMARY KEY,
+    agency_id INTEGER NOT NULL,
+    name      TEXT NOT NULL,
+    name_norm TEXT NOT NULL,
+    group_key TEXT NOT NULL,  -- agente_global (o el nombre) normalizado: el mismo agente en varias oficinas
+    mentions  INTEGER NOT NULL,
+    variants  TEXT            -- JSON
+);
+CREATE TABLE testimonials (
+    id        INTEGER PRIMARY KEY,
+    agent_id  INTEGER NOT NULL,
+    agency_id INTEGER NOT NULL,
+    text      TEXT NOT NULL
+);
+CREATE TABLE leaderboard (
+    rank      INTEGER PRIMARY KEY,
+    name      TEXT NOT NULL,
+    group_key TEXT NOT NULL,
+    mentions  INTEGER NOT NULL,
+    agencies  TEXT NOT NULL  -- JSON con los nombres de las agencias
+);
+-- Agente y agencia también en FTS5: texto + filtro se resuelven cruzando listas del índice
+CREATE VIEW testimonials_doc AS
+    SELECT t.id, t.text, a.group_key AS agent, 'a' || t.agency_id AS agency
+    FROM testimonials t JOIN agents a ON a.id = t.agent_id;
+CREATE VIRTUAL TABLE testimonials_fts USING fts5(
+    text, agent, agency, content='testimonials_doc', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+# Después de cargar los datos: más rápido que mantenerlos fila a fila
+INDEXES = """
+CREATE INDEX agencies_url ON agencies (agency_url);
+CREATE INDEX agencies_name ON agencies (agency_name);
+CREATE INDEX agents_name ON agents (name_norm);
+CREATE INDEX agents_group ON agents (group_key, mentions DESC);
+CREATE INDEX agents_agency ON agents (agency_id);
+CREATE INDEX agents_mentions ON agents (mentions DESC);
+CREATE INDEX testimonials_agent ON testimonials (agent_id, id);
+CREATE INDEX testimonials_agency ON testimonials (agency_id, id);
+INSERT INTO testimonials_fts (testimonials_fts) VALUES ('rebuild');
+
+-- El ranking global se calcula una vez aquí: consultarlo es leer filas.
+-- Con MAX(), SQLite toma `name` de la fila con más menciones del grupo.
+INSERT INTO leaderboard (name, group_key, mentions, agencies)
+SELECT name, group_key, total, agencies FROM (
+    SELECT a.name, MAX(a.mentions), a.group_key, SUM(a.mentions) AS total,
+           json_group_array(DISTINCT ag.agency_name) AS agencies
+    FROM agents a JOIN agencies ag ON ag.id = a.agency_id
+    GROUP BY a.group_key
+) ORDER BY total DESC, name;
+CREATE INDEX leaderboard_group ON leaderboard (group_key);
+"""
+
+
+def normalize_name(name):
+    """Minúsculas y sin tildes: "José" y "jose" son el mismo nombre."""
+    decomposed = unicodedata.normalize("NFKD", name.casefold())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def _phrase(word):
+    return '"' + word.replace('"', '""') + '"'
+
+
+def fts_query(text):
+    """Texto libre -> consulta FTS5 sobre la columna text: todas las palabras, la última como prefijo."""
+    words = [_phrase(w) for w in text.split()]
+    if not words:
+        return None
+    words[-1] += "*"
+    return "text : (" + " ".join(words) + ")"
+
+
+def _first_tokens(value):
+    """Frase FTS5 anclada al principio de la columna."""
+    return "^ " + " + ".join(_phrase(w) for w in value.split())
+
+
+def build_index(agencies, path=QUERY_DB):
+    """Crea el índice desde cero con las agencias de la salida (JSON/JSONL) y lo
+    sustituye de golpe, así que un `serve` en marcha nunca ve uno a medias.
+    """
+    t0 = time.perf_counter()
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    db.executescript("PRAGMA journal_mode=OFF; PRAGMA synchronous=OFF;" + SCHEMA)
+    counts = {"agencies": 0, "agents": 0, "testimonials": 0}
+    with db:
+        for agency in agencies:
+            agency_id = db.execute("INSERT INTO agencies (agency_url, agency_name) VALUES (?, ?)",
+                                   (agency["agency_url"], agency["agency_name"])).lastrowid
+            counts["agencies"] += 1
+            for agent in agency["agentes_inmobiliarios"]:
+                name = agent["nombre_agente"]
+                agent_id = db.execute(
+                    "INSERT INTO agents (agency_id, name, name_norm, group_key, mentions, variants) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (agency_id, name, normalize_name(name), normalize_name(agent.get("agente_global") or name),
+                     agent["total_menciones"], json.dumps(agent["variantes_nombre"], ensure_ascii=False)),
+                ).lastrowid
+                db.executemany("INSERT INTO testimonials (agent_id, agency_id, text) VALUES (?, ?, ?)",
+                               [(agent_id, agency_id, t["testimonio"]) for t in agent["testimonios_clientes"]])
+                counts["agents"] += 1
+                counts["testimonials"] += len(agent["testimonios_clientes"])
+    db.executescript(INDEXES)
+    db.execute("ANALYZE")
+    db.close()
+    os.replace(tmp, path)
+    print(f"🔎 Índice de consultas: {path} ({counts['agencies']} agencias, {counts['agents']} agentes, "
+          f"{counts['testimonials']} testimonios, {time.perf_counter() - t0:.1f}s)")
+    return counts
+
+
+class QueryIndex:
+    """Consultas sobre el índice de build_index.
+
+    Las conexiones de solo lectura se reutilizan entre peticiones (el
+    servidor abre un hilo por petición) hasta que build_index sustituye el
+    fichero.
+    """
+
+    def __init__(self, path=QUERY_DB):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"no existe el índice {path} (python query_service.py build ...)")
+        self.path = path
+        self._pool = []  # [(versión del fichero, conexión libre)]
+        self._lock = threading.Lock()
+        self._names = None  # (versión, [group_key]) para la búsqueda aproximada
+
+    def _version(self):
+        st = os.stat(self.path)
+        return st.st_ino, st.st_mtime_ns
+
+    @contextmanager
+    def _connect(self):
+        """Una conexión libre del pool, o una nueva si no hay o el índice se ha reconstruido."""
+        version, db = self._version(), None
+        with self._lock:
+            while self._pool and db is None:
+                v, free = self._pool.pop()
+                if v == version:
+                    db = free
+                else:
+                    free.close()
+        if db is None:
+            db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            with self._lock:
+                if len(self._pool) < POOL_SIZE:
+                    self._pool.append((version, db))
+                    db = None
+            if db is not None:
+                db.close()
+
+    def _leaderboard_rows(self, db, where, params, limit, offset=0):
+        rows = db.execute(
+            f"SELECT rank, name, group_key, mentions, agencies FROM leaderboard {where} "
+            "ORDER BY rank LIMIT ? OFFSET ?", (*params, limit, offset))
+        return [{"rank": r["rank"], "name": r["name"], "key": r["group_key"], "mentions": r["mentions"],
+                 "agencies": json.loads(r["agencies"])} for r in rows]
+
+    def search_agents(self, q, limit=DEFAULT_LIMIT, fuzzy=False):
+        """Agentes (agrupados entre oficinas) cuyo nombre empieza por `q`, o se le parece."""
+        norm = normalize_name(q)
+        if not norm:
+            return []
+        if not fuzzy:
+            # Rango sobre el índice: equivale a LIKE 'q%' sin recorrer la tabla
+            with self._connect() as db:
+                return self._leaderboard_rows(
+                    db,
+                    "WHERE group_key IN (SELECT DISTINCT group_key FROM agents WHERE name_norm >= ? AND name_norm < ?)",
+                    (norm, norm + "\U0010ffff"), limit)
+
+        from rapidfuzz import fuzz, process
+
+        with self._connect() as db:
+            version = self._version()
+            if self._names is None or self._names[0] != version:
+                self._names = (version, [k for (k,) in db.execute("SELECT group_key FROM leaderboard")])
+            matches = process.extract(norm, self._names[1], scorer=fuzz.WRatio, limit=limit, score_cutoff=FUZZY_CUTOFF)
+            scores = {key: round(score, 1) for key, score, _ in matches}
+            if not scores:
+                return []
+            rows = self._leaderboard_rows(db, f"WHERE group_key IN ({','.join('?' * len(scores))})",
+                                          list(scores), limit)
+        return sorted((dict(r, score=scores[r["key"]]) for r in rows), key=lambda r: (-r["score"], r["rank"]))
+
+    def agent_agencies(self, name):
+        """Agencias que mencionan al agente `name` (en cualquiera de sus oficinas)."""
+        norm = normalize_name(name)
+        with self._connect() as db:
+            rows = db.execute("""
+                SELECT ag.agency_name, ag.agency_url, a.name, a.mentions
+                FROM agents a JOIN agencies ag ON ag.id = a.agency_id
+                WHERE a.group_key = (SELECT group_key FROM agents WHERE name_norm = ? OR group_key = ? LIMIT 1)
+                ORDER BY a.mentions DESC
+            """, (norm, norm))
+            return [dict(r) for r in rows]
+
+    def testimonials(self, q=None, agent=None, agency=None, after=0, limit=DEFAULT_LIMIT):
+        """Testimonios por texto (FTS5), agente y/o agencia; paginados por cursor.
+
+        Devuelve {"items", "next"}: `next` es el `after` de la página
+        siguiente (None si no hay más).
+        """
+        with self._connect() as db:
+            return self._testimonials(db, q, agent, agency, after, limit)
+
+    def _testimonials(self, db, q, agent, agency, after, limit):
+        where, params = [], []
+        agency_ids = None
+        if agency:
+            agency_ids = [i for (i,) in db.execute(
+                "SELECT id FROM agencies WHERE agency_url = ? OR agency_name = ?", (agency, agency))]
+            if not agency_ids:
+                return {"items": [], "next": None}
+            where.append(f"t.agency_id IN ({','.join('?' * len(agency_ids))})")
+            params += agency_ids
+        group_keys = None
+        if agent:
+            norm = normalize_name(agent)
+            group_keys = [k for (k,) in db.execute(
+                "SELECT DISTINCT group_key FROM agents WHERE group_key = ? OR name_norm = ?", (norm, norm))]
+            if not group_keys:
+                return {"items": [], "next": None}
+            where.append("t.agent_id IN (SELECT id FROM agents WHERE group_key = ? OR name_norm = ?)")
+            params += [norm, norm]
+        
+        match = fts_query(q) if q else None
+        if match:
+            # Los filtros también van a FTS5 (el SQL de arriba deja solo los exactos)
+            if group_keys:
+                match += " AND agent : (" + " OR ".join(map(_first_tokens, group_keys)) + ")"
+            if agency_ids:
+                match += " AND agency : (" + " OR ".join(_phrase(f"a{i}") for i in agency_ids) + ")"
+            # Rango y orden sobre el rowid de FTS5: lo resuelve el propio índice
+            source, cursor = "testimonials_fts f JOIN testimonials t ON t.id = f.rowid", "f.rowid"
+            where.append("testimonials_fts MATCH ?")
+            params.append(match)
+        else:
+            source, cursor = "testimonials t", "t.id"
+        where.append(f"{cursor} > ?")
+        params.append(after)
+        rows = db.execute(f"""
+            SELECT t.id, t.text, a.name AS agent, ag.agency_name, ag.agency_url
+            FROM {source} JOIN agents a ON a.id = t.agent_id JOIN agencies ag ON ag.id = t.agency_id
+            WHERE {' AND '.join(where)} ORDER BY {cursor} LIMIT ?
+        """, (*params, limit + 1)).fetchall()
+        items = [dict(r) for r in rows[:limit]]
+        return {"items": items, "next": items[-1]["id"] if len(rows) > limit else None}
+
+    def leaderboard(self, limit=DEFAULT_LIMIT, offset=0):
+        with self._connect() as db:
+            return self._leaderboard_rows(db, "", (), limit, offset)
+
+    def stats(self):
+        with self._connect() as db:
+            return {table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                    for table in ("agencies", "agents", "testimonials")}
+
+
+def _int(params, name, default, minimum=0, maximum=None):
+    """Parámetro entero acotado: un LIMIT negativo sería "sin límite" para SQLite."""
+    value = max(minimum, int(params.get(name, [default])[0]))
+    return min(value, maximum) if maximum else value
+
+
+def serve(index, port=8765, host="127.0.0.1"):
+    """Sirve la API JSON de `index` (bloquea)."""
+
+    def route(path, params):
+        arg = lambda name: params.get(name, [None])[0]
+        limit = _int(params, "limit", DEFAULT_LIMIT, 1, MAX_LIMIT)
+        if path == "/agents":
+            return index.search_agents(arg("q") or "", limit, fuzzy=arg("fuzzy") in ("1", "true"))
+        if path == "/agencies":
+            return index.agent_agencies(arg("agent") or "")
+        if path == "/testimonials":
+            return index.testimonials(arg("q"), arg("agent"), arg("agency"), _int(params, "after", 0), limit)
+        if path == "/leaderboard":
+            return index.leaderboard(limit, _int(params, "offset", 0))
+        if path == "/stats":
+            return index.stats()
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            t0 = time.perf_counter()
+            try:
+                result = route(url.path.rstrip("/") or "/", parse_qs(url.query))
+                status = 200 if result is not None else 404
+                body = result if result is not None else {"error": "not found"}
+            except (ValueError, sqlite3.OperationalError) as e:
+                status, body = 400, {"error": str(e)}
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("X-Query-Ms", f"{(time.perf_counter() - t0) * 1000:.2f}")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    print(f"🔎 API de consultas en http://{host}:{port}/ ({index.path})")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+def read_agencies(path):
+    """Agencias de la salida del scraper: JSONL (una por línea) o el JSON completo."""
+    if path.endswith(".jsonl"):
+        from checkpoint import JsonlCheckpoint
+        return iter(JsonlCheckpoint(path))
+    with open(path, encoding="utf-8") as f:
+        return iter(json.load(f))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Índice y API de consultas de agentes y testimonios.")
+    parser.add_argument("--db", default=QUERY_DB, help="Fichero del índice (por defecto: %(default)s)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Crear el índice desde la salida del scraper")
+    build.add_argument("source", nargs="?", default="agentes_inmobiliarios.jsonl",
+                       help="JSONL o JSON de agencias (por defecto: %(default)s)")
+    run = sub.add_parser("serve", help="Servir la API HTTP/JSON")
+    run.add_argument("--port", type=int, default=8765)
+    run.add_argument("--host", default="127.0.0.1")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "build":
+        build_index(read_agencies(args.source), args.db)
+    else:
+        serve(QueryIndex(args.db), args.port, args.host)
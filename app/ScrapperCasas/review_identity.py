@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Identidad de una reseña: su data-review-id o, si no hay, una huella del texto.
+
+La misma reseña vuelve con otro texto entre scrolls: expandida con "Más",
+con otra fecha relativa u otro contador de "Me gusta". La huella se calcula
+sobre el texto sin esa cabecera ni esos botones, así que no cambia (o cambia
+pocos bits de la SimHash).
+"""
+
+import hashlib, re
+from collections import namedtuple
+
+SIMHASH_BITS = 64
+MAX_DISTANCE = 3  # Bits distintos entre dos SimHash de la misma reseña
+BANDS = MAX_DISTANCE + 1  # Con distancia <= 3, al menos una de 4 bandas de 16 bits coincide
+PREFIX_WORDS = 20  # Una reseña truncada comparte este principio con la expandida
+HEADER_CHARS = 200  # Autor, "Local Guide", estrellas...: lo que va antes de la fecha
+
+DATE_RE = re.compile(r"\b(?:editado\s+)?hace\s+(?:un|una|\d+)\s+"
+                     r"(?:segundos?|minutos?|horas?|días?|semanas?|mes(?:es)?|años?)\b")
+BOILERPLATE_RE = re.compile(r"…\s*más\b|…|\bver\s+más\b|\bme\s+gusta\b|\bcompartir\b|\blocal\s+guide\b"
+                            r"|\breseñas?\b|\bfotos?\b|\bestrellas?\b|\bnuevo\b")
+WORD_RE = re.compile(r"[^\W\d_]+")
+
+
+class Fingerprint(namedtuple("Fingerprint", "id simhash prefix")):
+    @property
+    def key(self):
+        """La clave en el almacén de reseñas (ver review_key)."""
+        if self.id:
+            return self.id
+        return "sim:%016x" % self.simhash + (":%016x" % self.prefix if self.prefix is not None else "")
+
+
+def normalize(text):
+    """Palabras del cuerpo de la reseña, sin cabecera, fechas, números ni botones."""
+    text = text.lower()
+    date = DATE_RE.search(text)
+    if date and date.start() < HEADER_CHARS:
+        text = text[date.end():]
+    text = DATE_RE.sub(" ", text)
+    return WORD_RE.findall(BOILERPLATE_RE.sub(" ", text))
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def simhash(words):
+    """SimHash de 64 bits sobre pares de palabras consecutivas."""
+    shingles = [" ".join(words[i:i + 2]) for i in range(max(1, len(words) - 1))] if words else []
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        h = _hash64(shingle)
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit, w in enumerate(weights) if w > 0)
+
+
+def fingerprint(card):
+    """Huella de una tarjeta {"id", "text"}: el id si lo hay; si no, SimHash y principio."""
+    if card.get("id"):
+        return Fingerprint(card["id"], None, None)
+    words = normalize(card["text"])
+    prefix = _hash64(" ".join(words[:PREFIX_WORDS])) if len(words) >= PREFIX_WORDS else None
+    return Fingerprint(None, simhash(words), prefix)
+
+
+def review_key(review_id, text):
+    """Clave estable de una reseña: su data-review-id o, si no hay, "sim:<SimHash>[:<principio>]".
+
+    La huella del principio va en la clave porque una reseña truncada y su
+    versión expandida pueden diferir en muchos bits de la SimHash.
+    """
+    return fingerprint({"id": review_id, "text": text}).key
+
+
+def key_fingerprint(key):
+    """La Fingerprint de una clave de review_key (sin el texto)."""
+    if not key.startswith("sim:"):
+        return Fingerprint(key, None, None)
+    simhash_hex, _, prefix_hex = key[4:].partition(":")
+    return Fingerprint(None, int(simhash_hex, 16), int(prefix_hex, 16) if prefix_hex else None)
+
+
+class ReviewDeduper:
+    """Reseñas ya vistas de una agencia y su posición en la lista de resultados.
+
+    Por reseña guarda solo claves de tamaño fijo (id o SimHash y huella del
+    principio), no el texto. Sin id, dos tarjetas son la misma reseña si sus
+    SimHash difieren en MAX_DISTANCE bits o menos, o si empiezan igual.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._prefixes = {}
+        self._bands = {}  # (banda, valor) -> [(simhash, posición)]
+
+    @staticmethod
+    def _band_keys(h):
+        width = SIMHASH_BITS // BANDS
+        return [(b, h >> (b * width) & ((1 << width) - 1)) for b in range(BANDS)]
+
+    def find(self, fp):
+        """Posición de una versión ya vista de la reseña, o None."""
+        if fp.id:
+            return self._ids.get(fp.id)
+        if fp.prefix is not None and fp.prefix in self._prefixes:
+            return self._prefixes[fp.prefix]
+        for key in self._band_keys(fp.simhash):
+            for h, pos in self._bands.get(key, ()):
+                if bin(h ^ fp.simhash).count("1") <= MAX_DISTANCE:
+                    return pos
+        return None
+
+    def add(self, fp, pos):
+        if fp.id:
+            self._ids[fp.id] = pos
+            return
+        if fp.prefix is not None:
+            self._prefixes.setdefault(fp.prefix, pos)
+        for key in self._band_keys(fp.simhash):
+            self._bands.setdefault(key, []).append((fp.simhash, pos))
+
+
+def known_index(keys):
+    """ReviewDeduper con claves del almacén, para reconocerlas aunque el texto varíe.
+
+    find() devuelve la clave guardada de la misma reseña.
+    """
+    index = ReviewDeduper()
+    for key in keys:
+        index.add(key_fingerprint(key), key)
+    return index
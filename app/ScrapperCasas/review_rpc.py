@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Decodifica las respuestas XHR con las que Google Maps carga las reseñas."""
+
+import json
+
+# Endpoints que devuelven la lista de reseñas (el primero es el actual)
+REVIEW_RPC_PATTERNS = (
+    "/maps/rpc/listugcposts",
+    "/maps/preview/review/listentitiesreviews",
+)
+XSSI_PREFIX = ")]}'"
+
+
+def is_review_rpc(url):
+    return any(p in url for p in REVIEW_RPC_PATTERNS)
+
+
+def _dig(obj, *path):
+    """Acceso tolerante a listas anidadas: devuelve None si falta algún nivel."""
+    for key in path:
+        try:
+            obj = obj[key]
+        except (IndexError, KeyError, TypeError):
+            return None
+    return obj
+
+
+def _review(review_id, author, date, body):
+    if not body:
+        return None
+    return {
+        "id": str(review_id or ""),
+        "author": author or "",
+        "date": date or "",
+        "body": body,
+        # Mismo orden que el texto de la tarjeta en el DOM
+        "text": " ".join(p for p in (author, date, body) if p),
+    }
+
+
+def decode_review_payload(url, payload):
+    """Devuelve (reseñas, hay_más) a partir del cuerpo de una respuesta.
+
+    Cada reseña es un dict con id, author, date, body (texto completo, sin
+    recortar por "Más") y text (todo junto, como el texto de la tarjeta).
+    """
+    payload = payload.lstrip()
+    if payload.startswith(XSSI_PREFIX):
+        payload = payload[len(XSSI_PREFIX):]
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return [], False
+
+    reviews = []
+    if "listugcposts" in url:
+        for entry in _dig(data, 2) or []:
+            r = _dig(entry, 0)
+            rev = _review(_dig(r, 0), _dig(r, 1, 4, 5, 0), _dig(r, 1, 6), _dig(r, 2, 15, 0, 0))
+            if rev:
+                reviews.append(rev)
+        # data[1] es el token de la página siguiente
+        return reviews, bool(_dig(data, 1))
+
+    for r in _dig(data, 2) or []:
+        rev = _review(_dig(r, 10), _dig(r, 0, 1), _dig(r, 1), _dig(r, 3))
+        if rev:
+            reviews.append(rev)
+    return reviews, bool(reviews)
+
+
+class ReviewCapture:
+    """Acumula las respuestas de reseñas que ve una pestaña.
+
+    El manejador de eventos solo guarda la respuesta; el cuerpo se lee fuera
+    del manejador (con `response.text()`), que funciona igual en la API
+    síncrona y en la asíncrona.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.responses = 0
+        self.has_more = True
+        self._ids = set()
+
+    def on_response(self, response):
+        if is_review_rpc(response.url):
+            self.pending.append(response)
+
+    def take(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def feed(self, url, payload):
+        """Decodifica un cuerpo y devuelve solo las reseñas no vistas."""
+        reviews, self.has_more = decode_review_payload(url, payload)
+        self.responses += 1
+
+        new = []
+        for rev in reviews:
+            key = rev["id"] or rev["text"]
+            if key not in self._ids:
+                self._ids.add(key)
+                new.append(rev)
+        return new
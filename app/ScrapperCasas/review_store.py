@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Almacén SQLite de reseñas en bruto, por agencia e id de reseña."""
+
+import json, sqlite3, time
+
+from review_identity import ReviewDeduper, key_fingerprint, known_index
+from review_identity import review_key  # Reexportada: la clave de las reseñas del almacén
+
+KEY_VERSION = 2  # PRAGMA user_version: formato de las claves sin id (review_key)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS agencies (
+    agency_url  TEXT PRIMARY KEY,
+    agency_name TEXT,
+    last_crawl  REAL
+);
+CREATE TABLE IF NOT EXISTS reviews (
+    agency_url  TEXT NOT NULL,
+    review_key  TEXT NOT NULL,
+    text        TEXT NOT NULL,
+    first_seen  REAL NOT NULL,
+    agents      TEXT,  -- JSON con los agentes validados; NULL = sin procesar
+    PRIMARY KEY (agency_url, review_key)
+);
+"""
+
+
+class ReviewStore:
+    """Reseñas ya vistas, para re-crawls incrementales.
+
+    Úsese desde un solo hilo (el principal): los workers reciben las claves
+    conocidas ya cargadas con `known_keys`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self._rekey()
+
+    def _rekey(self):
+        """Pasa las claves sin id de formatos anteriores ("sha1:", "sim:" sin principio) a las de review_key.
+
+        Las reseñas que resultan ser la misma se funden en una: la primera
+        que se vio (first_seen) con el texto más largo.
+        """
+        if self.db.execute("PRAGMA user_version").fetchone()[0] >= KEY_VERSION:
+            return
+        rows = self.db.execute(
+            "SELECT agency_url, text, first_seen, agents FROM reviews "
+            "WHERE review_key LIKE 'sha1:%' OR review_key LIKE 'sim:%' ORDER BY rowid").fetchall()
+        merged = {}  # agency_url -> (ReviewDeduper, {clave: [clave, texto, first_seen, agentes]})
+        for url, text, first_seen, agents in rows:
+            index, kept = merged.setdefault(url, (ReviewDeduper(), {}))
+            key = review_key(None, text)
+            fp = key_fingerprint(key)
+            match = index.find(fp)
+            if match is None:
+                index.add(fp, key)
+                kept[key] = [key, text, first_seen, agents]
+            elif len(text) > len(kept[match][1]):
+                kept[match] = [key, text, kept[match][2], agents]
+                index.add(fp, match)
+        with self.db:
+            self.db.execute("DELETE FROM reviews WHERE review_key LIKE 'sha1:%' OR review_key LIKE 'sim:%'")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO reviews (agency_url, review_key, text, first_seen, agents) VALUES (?, ?, ?, ?, ?)",
+                [(url, *row) for url, (_, kept) in merged.items() for row in kept.values()])
+            self.db.execute(f"PRAGMA user_version = {KEY_VERSION}")
+
+    def close(self):
+        self.db.close()
+
+    def known_keys(self, agency_url):
+        rows = self.db.execute("SELECT review_key FROM reviews WHERE agency_url = ?", (agency_url,))
+        return {key for (key,) in rows}
+
+    def save(self, agency):
+        """Guarda las reseñas de un resultado de scraping.
+
+        Una reseña ya guardada que vuelve con otro texto (truncada, expandida,
+        con otra fecha relativa) no se duplica: si llega más larga, sustituye
+        al texto guardado y se vuelve a extraer. Devuelve (cuántas eran
+        nuevas, {clave del scraping: clave guardada}).
+        """
+        url, now = agency["agency_url"], time.time()
+        lengths = dict(self.db.execute("SELECT review_key, length(text) FROM reviews WHERE agency_url = ?", (url,)))
+        index = known_index(lengths)
+        new, longer, matched = [], {}, {}
+        for key, text in zip(agency["review_keys"], agency["reviews"]):
+            fp = key_fingerprint(key)
+            match = index.find(fp)
+            if match is None:
+                index.add(fp, key)
+                lengths[key] = len(text)
+                new.append((url, key, text, now))
+                match = key
+            elif len(text) > lengths[match]:
+                lengths[match] = len(text)
+                longer[match] = (key, text, url, match)
+            matched[key] = match
+        # Las que sustituyen a una guardada se quedan con su clave
+        keys = {key: longer[match][0] if match in longer else match for key, match in matched.items()}
+        with self.db:
+            self.db.execute(
+                "INSERT INTO agencies (agency_url, agency_name, last_crawl) VALUES (?, ?, ?) "
+                "ON CONFLICT(agency_url) DO UPDATE SET agency_name = excluded.agency_name, "
+                "last_crawl = excluded.last_crawl",
+                (url, agency["agency_name"], now),
+            )
+            before = self.db.total_changes
+            self.db.executemany(
+                "INSERT OR IGNORE INTO reviews (agency_url, review_key, text, first_seen) VALUES (?, ?, ?, ?)", new)
+            added = self.db.total_changes - before
+            self.db.executemany(
+                "UPDATE OR IGNORE reviews SET review_key = ?, text = ?, agents = NULL "
+                "WHERE agency_url = ? AND review_key = ?", longer.values())
+            return added, keys
+
+    def agencies(self):
+        """Agencias guardadas: [(url, nombre)], en el orden en que se guardaron."""
+        return self.db.execute("SELECT agency_url, agency_name FROM agencies ORDER BY rowid").fetchall()
+
+    def set_agents(self, agency_url, pairs):
+        """Guarda los agentes extraídos: pairs = [(clave, [agentes])]."""
+        with self.db:
+            self.db.executemany(
+                "UPDATE reviews SET agents = ? WHERE agency_url = ? AND review_key = ?",
+                [(json.dumps(agents, ensure_ascii=False), agency_url, key) for key, agents in pairs],
+            )
+
+    def agency_reviews(self, agency_url):
+        """Todas las reseñas guardadas de una agencia: [(clave, texto, [agentes] o None, first_seen)].
+
+        None marca las reseñas aún sin extracción.
+        """
+        rows = self.db.execute(
+            "SELECT review_key, text, agents, first_seen FROM reviews WHERE agency_url = ? ORDER BY rowid",
+            (agency_url,),
+        )
+        return [(key, text, json.loads(agents) if agents is not None else None, first_seen)
+                for key, text, agents, first_seen in rows]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Cola de agencias con alquiler (lease) en SQLite, para repartir un crawl."""
+
+import sqlite3, threading, time
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    agency_url  TEXT PRIMARY KEY,
+    state       TEXT NOT NULL DEFAULT 'pending',  -- pending | leased | done | failed
+    worker      TEXT,
+    lease_until REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    updated     REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until);
+"""
+
+
+class LeaseQueue:
+    """Agencias pendientes que los workers alquilan por `ttl` segundos.
+
+    Un alquiler caducado (worker muerto) vuelve a estar disponible. Cada
+    operación abre su propia conexión, así que se puede usar desde varios
+    hilos y procesos. Entre máquinas, el fichero tiene que estar en un disco
+    compartido con bloqueos fiables (no todos los NFS lo son).
+    """
+
+    def __init__(self, path, ttl=600, max_attempts=3):
+        self.path = path
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        db = sqlite3.connect(path, timeout=60)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        db.close()
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def add(self, urls):
+        """Encola las URLs que no estuvieran ya; devuelve cuántas eran nuevas."""
+        with self._connect() as db:
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO jobs (agency_url, updated) VALUES (?, ?)",
+                           [(url, time.time()) for url in urls])
+            return db.total_changes - before
+
+    def lease(self, worker, n):
+        """Alquila hasta `n` agencias pendientes (o con el alquiler caducado)."""
+        now = time.time()
+        with self._connect() as db:
+            # Caducadas sin intentos restantes: el worker murió con ellas demasiadas veces
+            db.execute("UPDATE jobs SET state = 'failed', worker = NULL, lease_until = NULL, updated = ? "
+                       "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                       (now, now, self.max_attempts))
+            urls = [url for (url,) in db.execute(
+                "SELECT agency_url FROM jobs WHERE state = 'pending' "
+                "OR (state = 'leased' AND lease_until < ?) ORDER BY rowid LIMIT ?", (now, n))]
+            db.executemany(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1, updated = ? WHERE agency_url = ?",
+                [(worker, now + self.ttl, now, url) for url in urls])
+        return urls
+
+    def renew(self, worker):
+        """Alarga todos los alquileres de `worker`."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET lease_until = ?, updated = ? WHERE state = 'leased' AND worker = ?",
+                       (now + self.ttl, now, worker))
+
+    def done(self, url, worker):
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET state = 'done', lease_until = NULL, updated = ? "
+                       "WHERE agency_url = ? AND worker = ?", (time.time(), url, worker))
+
+    def fail(self, url, worker):
+        """Da por fallida una agencia alquilada que el worker ya reintentó: no vuelve a repartirse."""
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET state = 'failed', worker = NULL, lease_until = NULL, updated = ? "
+                       "WHERE agency_url = ? AND worker = ? AND state = 'leased'", (time.time(), url, worker))
+
+    def release(self, worker):
+        """Devuelve lo que `worker` no terminó: a pendiente, o a fallida si agotó los intentos."""
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_until = NULL, updated = ? WHERE state = 'leased' AND worker = ?",
+                (self.max_attempts, time.time(), worker))
+
+    def counts(self):
+        with self._connect() as db:
+            return dict(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    @contextmanager
+    def renewing(self, worker):
+        """Renueva los alquileres de `worker` en segundo plano mientras dure el bloque."""
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(self.ttl / 3):
+                try:
+                    self.renew(worker)
+                except sqlite3.Error:
+                    pass
+
+        thread = threading.Thread(target=run, name="lease-renew", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()